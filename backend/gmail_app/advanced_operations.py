@@ -1,17 +1,46 @@
 import logging
 import json
+import secrets
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from django.utils import timezone
-from celery import shared_task
+from celery import shared_task, chord
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from .gmail_utils import GmailServiceManager
-from .email_operations import EmailDeletionManager
+from .gmail_utils import GmailServiceManager, retry_gmail_operation, fetch_messages_metadata, extract_headers
+from .email_operations import EmailDeletionManager, deletion_stats_keys, AVERAGE_EMAIL_SIZE_KB
+from .models import GoogleOAuthToken
 
 
 
 logger = logging.getLogger(__name__)
 
+MAX_UNDO_POINTS = 10
+
+@contextmanager
+def user_cache_lock(user_id, name, ttl=10, attempts=5, wait=0.02):
+    """Per-user lock around cache read-modify-write, using cache.add (SET NX on Redis)"""
+    lock_key = f"lock_{user_id}_{name}"
+    # Identifies this holder, so release leaves alone a lock someone else has since taken
+    token = secrets.token_hex(16)
+    for attempt in range(attempts):
+        if cache.add(lock_key, token, ttl):
+            break
+        time.sleep(wait * (2 ** attempt))
+    else:
+        raise RuntimeError(f"Could not acquire {name} lock for user {user_id}")
+    
+    try:
+        yield
+    finally:
+        # Compare-then-delete through the public cache API, so any backend works. The two
+        # calls aren't atomic: if the lock expires and is re-acquired in between, the new
+        # holder's lock can still be removed, but only in that sub-millisecond window
+        # rather than for the whole overrun
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
 class EmailPreviewManager:
     """Manager for email preview functionality"""
     
@@ -26,52 +55,38 @@ class EmailPreviewManager:
             if not service:
                 return {'error': 'Gmail service not available'}
             
-            # Get total count
-            count_result = service.users().messages().list(
-                userId='me',
-                q=search_query,
-                maxResults=1
-            ).execute()
-            
-            total_count = count_result.get('resultSizeEstimate', 0)
+            # Get sample emails for preview; the same response carries the total estimate
+            def fetch_preview():
+                return service.users().messages().list(
+                    userId='me',
+                    q=search_query,
+                    maxResults=sample_size,
+                    fields='messages/id,resultSizeEstimate'
+                ).execute()
             
-            # Get sample emails for preview
-            preview_result = service.users().messages().list(
-                userId='me',
-                q=search_query,
-                maxResults=sample_size
-            ).execute()
+            preview_result = retry_gmail_operation(fetch_preview)
             
+            total_count = preview_result.get('resultSizeEstimate', 0)
             messages = preview_result.get('messages', [])
             
-            # Get metadata for preview emails
+            # Get metadata for preview emails in batched requests
             preview_emails = []
-            for msg in messages[:sample_size]:
-                try:
-                    message = service.users().messages().get(
-                        userId='me',
-                        id=msg['id'],
-                        format='metadata',
-                        metadataHeaders=['From', 'To', 'Subject', 'Date']
-                    ).execute()
-                    
-                    headers = {h['name']: h['value'] for h in message.get('payload', {}).get('headers', [])}
-                    
-                    preview_emails.append({
-                        'id': message['id'],
-                        'from': headers.get('From', 'Unknown'),
-                        'subject': headers.get('Subject', 'No Subject'),
-                        'date': headers.get('Date', 'Unknown'),
-                        'snippet': message.get('snippet', '')[:100] + '...',
-                        'size_estimate': message.get('sizeEstimate', 0)
-                    })
-                    
-                except Exception as e:
-                    logger.warning(f"Failed to get preview for message {msg['id']}: {e}")
-                    continue
+            total_size_estimate = 0
+            for message in fetch_messages_metadata(service, [msg['id'] for msg in messages[:sample_size]], user_id=self.user.id):
+                headers = extract_headers(message)
+                size_estimate = message.get('sizeEstimate', 0)
+                total_size_estimate += size_estimate
+                
+                preview_emails.append({
+                    'id': message['id'],
+                    'from': headers['From'],
+                    'subject': headers['Subject'],
+                    'date': headers['Date'],
+                    'snippet': message.get('snippet', '')[:100] + '...',
+                    'size_estimate': size_estimate
+                })
             
             # Calculate estimated storage savings
-            total_size_estimate = sum([email['size_estimate'] for email in preview_emails])
             avg_size = total_size_estimate / len(preview_emails) if preview_emails else 0
             estimated_total_size = avg_size * total_count
             
@@ -90,20 +105,19 @@ class EmailPreviewManager:
     def get_deletion_statistics(self, days_back=30):
         """Get deletion statistics for user"""
         try:
-            # Get stats from cache/database
-            cache_key = f"deletion_stats_{self.user.id}_{days_back}"
-            stats = cache.get(cache_key)
-            
-            if not stats:
-                # Calculate stats (implement based on your logging system)
-                stats = {
-                    'total_deleted': 0,
-                    'storage_saved_mb': 0,
-                    'deletion_sessions': 0,
-                    'most_deleted_category': 'promotions',
-                    'avg_emails_per_session': 0
-                }
-                cache.set(cache_key, stats, 3600)  # Cache for 1 hour
+            # Derived figures are computed from the raw counters on read
+            total_key, sessions_key = deletion_stats_keys(self.user.id, days_back)
+            counters = cache.get_many([total_key, sessions_key])
+            total_deleted = counters.get(total_key, 0)
+            deletion_sessions = counters.get(sessions_key, 0)
+            
+            stats = {
+                'total_deleted': total_deleted,
+                'storage_saved_mb': round(total_deleted * AVERAGE_EMAIL_SIZE_KB / 1024, 2),
+                'deletion_sessions': deletion_sessions,
+                'most_deleted_category': 'promotions',
+                'avg_emails_per_session': total_deleted / deletion_sessions if deletion_sessions else 0
+            }
             
             return stats
             
@@ -117,6 +131,12 @@ class SmartDeletionRules:
     def __init__(self, user):
         self.user = user
         self.deletion_manager = EmailDeletionManager(user)
+        # Rule ids are indexed under one key, each rule is stored under its own key
+        self.index_key = f"deletion_rules_{user.id}"
+        self.seq_key = f"deletion_rule_seq_{user.id}"
+    
+    def _rule_key(self, rule_id):
+        return f"deletion_rule_{self.user.id}_{rule_id}"
     
     def create_deletion_rule(self, rule_config):
         """Create a smart deletion rule"""
@@ -126,8 +146,11 @@ class SmartDeletionRules:
             if not all(field in rule_config for field in required_fields):
                 return {'error': 'Missing required rule fields'}
             
+            # Atomic sequence so concurrent creates never share an id
+            cache.add(self.seq_key, 0, None)
+            rule_id = f"rule_{self.user.id}_{cache.incr(self.seq_key)}"
+            
             # Store rule in cache/database
-            rule_id = f"rule_{self.user.id}_{len(self.get_user_rules())}"
             rule_data = {
                 'id': rule_id,
                 'user_id': self.user.id,
@@ -141,10 +164,13 @@ class SmartDeletionRules:
             }
             
             # Store in cache (in production, use database)
-            cache_key = f"deletion_rules_{self.user.id}"
-            user_rules = cache.get(cache_key, [])
-            user_rules.append(rule_data)
-            cache.set(cache_key, user_rules, 86400)  # Cache for 24 hours
+            with user_cache_lock(self.user.id, 'deletion_rules'):
+                rule_ids = cache.get(self.index_key, [])
+                rule_ids.append(rule_id)
+                cache.set_many({
+                    self._rule_key(rule_id): rule_data,
+                    self.index_key: rule_ids
+                }, 86400)  # Cache for 24 hours
             
             logger.info(f"Created deletion rule {rule_id} for user {self.user.username}")
             return {'status': 'created', 'rule': rule_data}
@@ -156,17 +182,21 @@ class SmartDeletionRules:
     def get_user_rules(self):
         """Get all deletion rules for user"""
         try:
-            cache_key = f"deletion_rules_{self.user.id}"
-            return cache.get(cache_key, [])
+            rule_keys = [self._rule_key(rule_id) for rule_id in cache.get(self.index_key, [])]
+            rules = cache.get_many(rule_keys)
+            return [rules[key] for key in rule_keys if key in rules]
         except Exception as e:
             logger.error(f"Get rules error: {e}")
             return []
     
+    def get_rule(self, rule_id):
+        """Get a single deletion rule by id"""
+        return cache.get(self._rule_key(rule_id))
+    
     def execute_rule(self, rule_id):
         """Execute a specific deletion rule"""
         try:
-            rules = self.get_user_rules()
-            rule = next((r for r in rules if r['id'] == rule_id), None)
+            rule = self.get_rule(rule_id)
             
             if not rule:
                 return {'error': 'Rule not found'}
@@ -182,14 +212,14 @@ class SmartDeletionRules:
             )
             
             if 'error' not in result:
-                # Update rule statistics
-                rule['last_run'] = timezone.now().isoformat()
-                rule['total_deleted'] += result.get('successful', 0)
-                
-                # Update cache
-                cache_key = f"deletion_rules_{self.user.id}"
-                updated_rules = [r if r['id'] != rule_id else rule for r in rules]
-                cache.set(cache_key, updated_rules, 86400)
+                # Re-read under the lock so concurrent runs don't lose each other's stats
+                with user_cache_lock(self.user.id, rule_id):
+                    rule = self.get_rule(rule_id) or rule
+                    rule['last_run'] = timezone.now().isoformat()
+                    rule['total_deleted'] += result.get('successful', 0)
+                    
+                    # Update only this rule's entry
+                    cache.set(self._rule_key(rule_id), rule, 86400)
             
             return result
             
@@ -203,31 +233,61 @@ class UndoManager:
     def __init__(self, user):
         self.user = user
         self.deletion_manager = EmailDeletionManager(user)
+        # Each undo point expires under its own key; an atomic sequence assigns
+        # it one of the last MAX_UNDO_POINTS history slots
+        self.seq_key = f"undo_seq_{user.id}"
+    
+    def _undo_key(self, undo_id):
+        return f"undo_point_{self.user.id}_{undo_id}"
+    
+    def _ids_key(self, undo_id):
+        return f"undo_ids_{self.user.id}_{undo_id}"
+    
+    def _metadata_key(self, undo_id):
+        return f"undo_metadata_{self.user.id}_{undo_id}"
+    
+    def _slot_key(self, seq):
+        return f"undo_slot_{self.user.id}_{seq % MAX_UNDO_POINTS}"
     
     def create_undo_point(self, operation_data):
         """Create an undo point before bulk operations"""
         try:
-            undo_id = f"undo_{self.user.id}_{int(timezone.now().timestamp())}"
+            now = timezone.now()
+            expires_at = now + timedelta(hours=24)
+            
+            # The sequence number names the point as well as picking its slot, so two
+            # points created in the same second never share a key
+            cache.add(self.seq_key, 0, None)
+            seq = cache.incr(self.seq_key)
+            undo_id = f"undo_{self.user.id}_{seq}"
             
+            message_ids = operation_data.get('message_ids') or []
             undo_data = {
                 'id': undo_id,
                 'user_id': self.user.id,
                 'operation_type': operation_data.get('type', 'bulk_delete'),
-                'affected_emails': operation_data.get('message_ids', []),
+                'affected_count': len(message_ids),
                 'search_query': operation_data.get('search_query'),
-                'created_at': timezone.now().isoformat(),
-                'expires_at': (timezone.now() + timedelta(hours=24)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'created_at': now.isoformat(),
+                'expires_at': expires_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'expires_at_ts': int(expires_at.timestamp()),
+                'has_metadata': bool(operation_data.get('metadata')),
                 'can_undo': True
             }
             
-            # Store undo point (in production, use database)
-            cache_key = f"undo_points_{self.user.id}"
-            undo_points = cache.get(cache_key, [])
-            undo_points.append(undo_data)
-            
-            # Keep only last 10 undo points
-            undo_points = undo_points[-10:]
-            cache.set(cache_key, undo_points, 86400)
+            # Store undo point (in production, use database).
+            # Keep only last 10 undo points: the slot is overwritten 10 creations later.
+            # The ids are stored apart, as one string the cache serializer compresses,
+            # so listing history never loads them
+            entries = {
+                self._undo_key(undo_id): undo_data,
+                self._slot_key(seq): undo_id
+            }
+            if message_ids:
+                entries[self._ids_key(undo_id)] = ','.join(message_ids)
+            if operation_data.get('metadata'):
+                entries[self._metadata_key(undo_id)] = operation_data['metadata']
+            cache.set_many(entries, 86400)
             
             return {'status': 'created', 'undo_id': undo_id}
             
@@ -236,24 +296,21 @@ class UndoManager:
             return {'error': str(e)}
         
     
+    def get_undo_metadata(self, undo_id):
+        """Get the email snapshot stored with an undo point, if one was taken"""
+        return cache.get(self._metadata_key(undo_id)) or []
+    
     def execute_undo(self, undo_id):
         """Execute undo operation"""
         try:
-            cache_key = f"undo_points_{self.user.id}"
-            undo_points = cache.get(cache_key, [])
-            
-            undo_point = next((u for u in undo_points if u['id'] == undo_id), None)
+            undo_point = cache.get(self._undo_key(undo_id))
             
             if not undo_point:
                 return {'error': 'Undo point not found'}
             
             # Check if expired
-            from django.utils.dateparse import parse_datetime
-            expire_time = parse_datetime(undo_point['expires_at'])
-            if expire_time.tzinfo is None:
-                expire_time = timezone.make_aware(expire_time)    
-
-            if timezone.now() > expire_time:
+            now_ts = int(timezone.now().timestamp())
+            if now_ts > undo_point['expires_at_ts']:
                 return {'error': 'Undo point has expired (24 hour limit)'}
             
             if not undo_point['can_undo']:
@@ -261,24 +318,26 @@ class UndoManager:
             
             # Execute recovery based on operation type
             if undo_point['operation_type'] in ['bulk_delete', 'bulk_delete_query']:
-                if undo_point.get('search_query'):
-                    # For query-based deletions, recover from trash using the same query
-                    trash_query = f"in:trash ({undo_point['search_query']})"
+                affected_emails = []
+                if undo_point.get('affected_count'):
+                    stored_ids = cache.get(self._ids_key(undo_id))
+                    affected_emails = stored_ids.split(',') if stored_ids else []
+                
+                if undo_point.get('search_query') and not affected_emails:
+                    # Without recorded ids, recover from trash using the same query
                     result = self.deletion_manager.recover_by_query(
-                        search_query=undo_point['search_query'],  # Remove the query, just recover from trash
+                        search_query=undo_point['search_query'],
                         max_emails=5000
                     )
                 else:
-                    # Recover by message IDs
-                    result = self.deletion_manager.fast_batch_recover_emails(
-                        undo_point['affected_emails']
-                    )
+                    # Recover the exact message IDs, no trash listing needed
+                    result = self.deletion_manager.fast_batch_recover_emails(affected_emails)
                 
-                # Mark as used
+                # Mark as used, keeping the original expiry
                 undo_point['can_undo'] = False
                 undo_point['executed_at'] = timezone.now().isoformat()
-                updated_points = [u if u['id'] != undo_id else undo_point for u in undo_points]
-                cache.set(cache_key, updated_points, 86400)
+                remaining = undo_point['expires_at_ts'] - int(timezone.now().timestamp())
+                cache.set(self._undo_key(undo_id), undo_point, max(remaining, 1))
                 
                 return result
             
@@ -292,35 +351,80 @@ class UndoManager:
     def get_undo_history(self):
         """Get available undo points for user"""
         try:
-            cache_key = f"undo_points_{self.user.id}"
-            undo_points = cache.get(cache_key, [])
+            seq = cache.get(self.seq_key, 0)
+            slot_keys = [self._slot_key(n) for n in range(max(seq - MAX_UNDO_POINTS, 0) + 1, seq + 1)]
+            slots = cache.get_many(slot_keys)
+            undo_keys = [self._undo_key(slots[key]) for key in slot_keys if key in slots]
+            undo_points = cache.get_many(undo_keys)
             
             # Filter non-expired points
-            current_time = timezone.now()
-            active_points = []
-            
-            for point in undo_points:
-                expire_time = datetime.fromisoformat(point['expires_at'].replace('Z', '+00:00'))
-                if current_time <= expire_time:
-                    active_points.append(point)
-            
-            return active_points
+            now_ts = int(timezone.now().timestamp())
+            return [
+                undo_points[key] for key in undo_keys
+                if key in undo_points and undo_points[key]['expires_at_ts'] >= now_ts
+            ]
             
         except Exception as e:
             logger.error(f"Undo history error: {e}")
             return []
         
 
+def _rule_is_due(rule, now):
+    """Check whether a rule's schedule has elapsed since its last run"""
+    if not rule['last_run']:
+        return True
+    return datetime.fromisoformat(rule['last_run']) <= now - timedelta(days=rule['schedule_days'])
+
+@shared_task
+def execute_user_rules(user_id):
+    """Celery task to execute one user's due deletion rules"""
+    try:
+        user = User.objects.get(id=user_id)
+        rules_manager = SmartDeletionRules(user)
+        now = timezone.now()
+        
+        rules_executed = 0
+        total_deleted = 0
+        for rule in rules_manager.get_user_rules():
+            if not rule['enabled'] or not _rule_is_due(rule, now):
+                continue
+            
+            result = rules_manager.execute_rule(rule['id'])
+            if 'error' not in result:
+                rules_executed += 1
+                total_deleted += result.get('successful', 0)
+        
+        return {'user_id': user_id, 'rules_executed': rules_executed, 'total_deleted': total_deleted}
+        
+    except User.DoesNotExist:
+        return {'user_id': user_id, 'rules_executed': 0, 'total_deleted': 0}
+    except Exception as e:
+        logger.error(f"Scheduled rules error for user {user_id}: {e}")
+        return {'user_id': user_id, 'rules_executed': 0, 'total_deleted': 0, 'error': str(e)}
+
+@shared_task
+def aggregate_rule_results(results):
+    """Celery chord callback summarizing scheduled rule execution"""
+    rules_executed = sum(r.get('rules_executed', 0) for r in results)
+    total_deleted = sum(r.get('total_deleted', 0) for r in results)
+    
+    logger.info(f"Scheduled rules execution completed: {rules_executed} rules for {len(results)} users, {total_deleted} emails deleted")
+    return {'status': 'completed', 'rules_executed': rules_executed, 'total_deleted': total_deleted}
+
 @shared_task
 def execute_scheduled_rules():
-    """Celery task to execute scheduled deletion rules"""
+    """Celery task to execute scheduled deletion rules, one sub-task per user"""
     try:
-        # Get all users with deletion rules (implement based on your storage)
-        # For now, this is a placeholder
+        # Only users with Gmail access can have rules executed
+        user_ids = list(GoogleOAuthToken.objects.values_list('user_id', flat=True))
+        if not user_ids:
+            return {'status': 'completed', 'rules_executed': 0}
+        
+        # Users run in parallel across workers; the callback aggregates the results
+        chord(execute_user_rules.s(user_id) for user_id in user_ids)(aggregate_rule_results.s())
         
-        logger.info("Scheduled rules execution completed")
-        return {'status': 'completed', 'rules_executed': 0}
+        return {'status': 'dispatched', 'users': len(user_ids)}
         
     except Exception as e:
         logger.error(f"Scheduled rules execution error: {e}")
-        return {'status': 'error', 'message': str(e)}
\ No newline at end of file
+        return {'status': 'error', 'message': str(e)}
@@ -0,0 +1,32 @@
+import hashlib
+import threading
+import time
+from cachetools import TTLCache
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWT authentication that reuses recent verifications of the same access token
+    
+    Clients send the same token on every call, so for a short window the signature
+    check is served from a process-local cache. Tokens are still rejected once they
+    expire. The user is loaded on every request, so profile edits and deactivations
+    take effect at once in every worker.
+    """
+    
+    TOKEN_TTL = 30
+    
+    _tokens = TTLCache(maxsize=10000, ttl=TOKEN_TTL)
+    _lock = threading.Lock()
+    
+    def get_validated_token(self, raw_token):
+        key = hashlib.blake2b(raw_token, digest_size=16).hexdigest()
+        with self._lock:
+            validated_token = self._tokens.get(key)
+        if validated_token is not None and validated_token.get('exp', 0) > time.time():
+            return validated_token
+        
+        validated_token = super().get_validated_token(raw_token)
+        with self._lock:
+            self._tokens[key] = validated_token
+        return validated_token
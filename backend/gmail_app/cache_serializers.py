@@ -0,0 +1,22 @@
+import zlib
+from django.core.cache.backends.redis import RedisSerializer
+
+
+class CompressedRedisSerializer(RedisSerializer):
+    """Redis cache serializer that zlib-compresses large pickled values"""
+    
+    # Undo points carry message id lists that compress well; small values are left as-is
+    min_compress_length = 1024
+    marker = b'Z:'
+    
+    def dumps(self, obj):
+        data = super().dumps(obj)
+        # Integers are stored raw so that cache.incr keeps working
+        if isinstance(data, bytes) and len(data) > self.min_compress_length:
+            return self.marker + zlib.compress(data, 3)
+        return data
+    
+    def loads(self, data):
+        if data.startswith(self.marker):
+            data = zlib.decompress(data[len(self.marker):])
+        return super().loads(data)
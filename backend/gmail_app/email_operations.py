@@ -1,20 +1,45 @@
 import logging
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Optional
-from celery import shared_task
+from celery import shared_task, group, chord
+from celery.exceptions import Ignore
+from celery.signals import worker_process_init
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from googleapiclient.errors import HttpError
-from .gmail_utils import GmailServiceManager, handle_gmail_api_error, retry_gmail_operation
+from .gmail_utils import GmailServiceManager, handle_gmail_api_error, retry_gmail_operation, invalidate_messages_metadata, fetch_messages_metadata, extract_headers, GMAIL_MAX_WORKERS, QuotaPacer
 from .models import GoogleOAuthToken
-import time
 
 logger = logging.getLogger(__name__)
 
+# Query pipelines: listed pages waiting for a worker, and workers processing them
+PIPELINE_QUEUE_SIZE = 4
+PIPELINE_WORKERS = 3
+# How often a blocked hand-off rechecks that a worker is still alive to take it
+PIPELINE_PUT_TIMEOUT = 5
+
+# Gmail message ids are lowercase hex; one malformed id fails a whole batchDelete/batchModify call
+MESSAGE_ID_PATTERN = re.compile(r'[0-9a-f]+')
+
+def clean_message_ids(message_ids):
+    """Drop duplicate, empty and malformed message ids, keeping the original order"""
+    unique_ids = [msg_id for msg_id in dict.fromkeys(message_ids) if msg_id]
+    valid_ids = [msg_id for msg_id in unique_ids if isinstance(msg_id, str) and MESSAGE_ID_PATTERN.fullmatch(msg_id)]
+    if len(valid_ids) < len(unique_ids):
+        logger.warning(f"Skipping {len(unique_ids) - len(valid_ids)} malformed message ids")
+    return valid_ids
+
 class EmailDeletionManager:
     """Manager for email deletion operations"""
     
     def __init__(self, user):
         self.user = user
         self.service_manager = GmailServiceManager(user)
+        self.pacer = QuotaPacer()
     
     def delete_single_email(self, message_id, permanent=False):
         """Delete a single email (trash or permanent)"""
@@ -31,6 +56,7 @@ class EmailDeletionManager:
                     ).execute()
                 
                 retry_gmail_operation(delete_operation)
+                invalidate_messages_metadata(self.user.id, [message_id])
                 
                 logger.info(f"Permanently deleted email {message_id} for user {self.user.username}")
                 return {
@@ -46,6 +72,7 @@ class EmailDeletionManager:
                     ).execute()
                 
                 result = retry_gmail_operation(trash_operation)
+                invalidate_messages_metadata(self.user.id, [message_id])
                 
                 logger.info(f"Moved email {message_id} to trash for user {self.user.username}")
                 return {
@@ -84,6 +111,7 @@ class EmailDeletionManager:
                 ).execute()
             
             result = retry_gmail_operation(untrash_operation)
+            invalidate_messages_metadata(self.user.id, [message_id])
             
             logger.info(f"Recovered email {message_id} from trash for user {self.user.username}")
             return {
@@ -109,60 +137,136 @@ class EmailDeletionManager:
             return {'error': {'message': str(e), 'type': 'unknown'}}
         
 
-    def fast_batch_delete_emails(self, message_ids, permanent=False, batch_size=1000):
-        """Fast deletion using batchModify (PhotoPurge style)"""
+    def _execute_batch(self, batch_number, batch_ids, build_request):
+        """Execute one batch request, returning an error entry on failure"""
+        # httplib2 transports are not thread-safe, so each worker gets its own
+        http = self.service_manager.authorized_http()
+        request = build_request(batch_ids)
+        
+        self.pacer.wait()
         try:
-            service = self.service_manager.get_service()
-            if not service:
-                return {'error': 'Gmail service not available'}
+            retry_gmail_operation(lambda: request.execute(http=http))
+            self.pacer.record()
+            invalidate_messages_metadata(self.user.id, batch_ids)
+            # Per-batch detail only; callers log one summary for the whole run
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Fast batch {batch_number} completed: {len(batch_ids)} emails")
+            return None
             
-            total_successful = 0
-            total_failed = 0
-            all_errors = []
+        except HttpError as e:
+            logger.error(f"Fast batch error: {e}")
+            self.pacer.record(e)
+            if e.resp.status == 401:
+                # Rebuild with fresh credentials, and don't hand this manager to the next task
+                self.service_manager.invalidate()
+            return {
+                'batch': batch_number,
+                'error': str(e),
+                'message_count': len(batch_ids)
+            }
+        except Exception as e:
+            # e.g. RefreshError on a revoked grant, or a network error that outlasted the retries.
+            # Raising here would kill a pipeline worker and leave the listing thread blocked
+            logger.error(f"Fast batch error: {e}")
+            return {
+                'batch': batch_number,
+                'error': str(e),
+                'message_count': len(batch_ids)
+            }
+    
+    def _run_batches(self, message_ids, batch_size, build_request, progress_callback=None):
+        """Execute one Gmail request per batch of ids concurrently on a small thread pool
+        
+        build_request(batch_ids) returns the unexecuted request for a batch. Each worker
+        uses its own HTTP transport, and 429s slow every worker through the shared pacer.
+        Returns (successful, failed, errors).
+        """
+        total_successful = 0
+        total_failed = 0
+        all_errors = []
+        
+        batches = [
+            (i // batch_size + 1, message_ids[i:i + batch_size])
+            for i in range(0, len(message_ids), batch_size)
+        ]
+        
+        with ThreadPoolExecutor(max_workers=min(GMAIL_MAX_WORKERS, len(batches) or 1)) as executor:
+            futures = {
+                executor.submit(self._execute_batch, batch_number, batch_ids, build_request): (batch_number, batch_ids)
+                for batch_number, batch_ids in batches
+            }
             
-            # Process in batches of 1000 (batchModify limit)
-            for i in range(0, len(message_ids), batch_size):
-                batch_ids = message_ids[i:i + batch_size]
-                
+            for future in as_completed(futures):
+                batch_number, batch_ids = futures[future]
                 try:
-                    if permanent:
-                        # For permanent deletion, use batchDelete if available
-                        # or fall back to individual delete calls
-                        for msg_id in batch_ids:
-                            service.users().messages().delete(
-                                userId='me',
-                                id=msg_id   
-                            ).execute()
-                            time.sleep(0.01)  # Minimal delay
-                    else:
-                        # Fast trash using batchModify
-                        service.users().messages().batchModify(
-                            userId='me',
-                            body={
-                                'ids': batch_ids,
-                                'addLabelIds': ['TRASH'],
-                                'removeLabelIds': ['INBOX']
-                            }
-                        ).execute()
-                    
-                    total_successful += len(batch_ids)
-                    logger.info(f"Fast batch {i//batch_size + 1} completed: {len(batch_ids)} emails")
-                    
-                except HttpError as e:
+                    error = future.result()
+                except Exception as e:
+                    # Keep the other batches' counts; this one is reported like an API error
                     logger.error(f"Fast batch error: {e}")
-                    total_failed += len(batch_ids)
-                    all_errors.append({
-                        'batch': i//batch_size + 1,
+                    error = {
+                        'batch': batch_number,
                         'error': str(e),
                         'message_count': len(batch_ids)
-                    })
-                    
-                    # Rate limit handling
-                    if e.resp.status == 429:
-                        time.sleep(2.0)
+                    }
+                if error:
+                    total_failed += len(batch_ids)
+                    all_errors.append(error)
+                else:
+                    total_successful += len(batch_ids)
                 
-                # Small delay between batches
-                time.sleep(0.1)
+                if progress_callback:
+                    progress_callback(total_successful + total_failed, len(message_ids))
+        
+        all_errors.sort(key=lambda error: error['batch'])
+        logger.info(f"Fast batch complete: {len(batches)} batches, {total_successful} emails for user {self.user.username}")
+        return total_successful, total_failed, all_errors
+    
+    def _delete_request_builder(self, service, permanent):
+        def build_request(batch_ids):
+            if permanent:
+                # Permanently delete the whole batch in one call
+                return service.users().messages().batchDelete(
+                    userId='me',
+                    body={'ids': batch_ids}
+                )
+            # Fast trash using batchModify; TRASH alone hides the message everywhere, and
+            # leaving INBOX in place lets recovery restore it to where it was
+            return service.users().messages().batchModify(
+                userId='me',
+                body={
+                    'ids': batch_ids,
+                    'addLabelIds': ['TRASH']
+                }
+            )
+        return build_request
+    
+    def _recover_request_builder(self, service):
+        def build_request(batch_ids):
+            # Fast recovery using batchModify; messages keep the labels they had when trashed
+            return service.users().messages().batchModify(
+                userId='me',
+                body={
+                    'ids': batch_ids,
+                    'removeLabelIds': ['TRASH']
+                }
+            )
+        return build_request
+    
+    def fast_batch_delete_emails(self, message_ids, permanent=False, batch_size=1000, progress_callback=None):
+        """Fast deletion using batchDelete/batchModify (PhotoPurge style)
+        
+        Batches run concurrently; progress_callback, if given, is called as
+        (processed, total) after each batch.
+        """
+        try:
+            service = self.service_manager.get_service()
+            if not service:
+                return {'error': 'Gmail service not available'}
+            
+            # Process in batches of 1000 (batchDelete/batchModify limit)
+            total_successful, total_failed, all_errors = self._run_batches(
+                message_ids, batch_size, self._delete_request_builder(service, permanent), progress_callback
+            )
             
             return {
                 'status': 'completed',
@@ -178,50 +282,17 @@ class EmailDeletionManager:
             return {'error': {'message': str(e), 'type': 'fast_batch_error'}}
         
 
-    def fast_batch_recover_emails(self, message_ids, batch_size=1000):
-        """Fast recovery using batchModify (remove TRASH label)"""
+    def fast_batch_recover_emails(self, message_ids, batch_size=1000, progress_callback=None):
+        """Fast recovery using batchModify (remove TRASH label), batches run concurrently"""
         try:
             service = self.service_manager.get_service()
             if not service:
                 return {'error': 'Gmail service not available'}
             
-            total_successful = 0
-            total_failed = 0
-            all_errors = []
-            
             # Process in batches of 1000 (batchModify limit)
-            for i in range(0, len(message_ids), batch_size):
-                batch_ids = message_ids[i:i + batch_size]
-                
-                try:
-                    # Fast recovery using batchModify
-                    service.users().messages().batchModify(
-                        userId='me',
-                        body={
-                            'ids': batch_ids,
-                            'removeLabelIds': ['TRASH'],
-                            'addLabelIds': ['INBOX']  # Move back to inbox
-                        }
-                    ).execute()
-                    
-                    total_successful += len(batch_ids)
-                    logger.info(f"Fast recovery batch {i//batch_size + 1} completed: {len(batch_ids)} emails")
-                    
-                except HttpError as e:
-                    logger.error(f"Fast recovery batch error: {e}")
-                    total_failed += len(batch_ids)
-                    all_errors.append({
-                        'batch': i//batch_size + 1,
-                        'error': str(e),
-                        'message_count': len(batch_ids)
-                    })
-                    
-                    # Rate limit handling
-                    if e.resp.status == 429:
-                        time.sleep(2.0)
-                
-                # Small delay between batches
-                time.sleep(0.1)
+            total_successful, total_failed, all_errors = self._run_batches(
+                message_ids, batch_size, self._recover_request_builder(service), progress_callback
+            )
             
             return {
                 'status': 'completed',
@@ -236,58 +307,170 @@ class EmailDeletionManager:
             logger.error(f"Fast batch recover error: {e}")
             return {'error': {'message': str(e), 'type': 'fast_recovery_error'}}
         
-
-
-    def delete_by_query(self, search_query, max_emails=5000, permanent=False):
-        """Delete emails by search query instead of individual IDs"""
+    def iter_message_id_pages(self, search_query, max_emails=5000):
+        """Yield pages of ids of emails matching a search query, up to max_emails"""
+        service = self.service_manager.get_service()
+        if not service:
+            return
+        
+        found = 0
+        page_token = None
+        
+        while found < max_emails:
+            try:
+                # Search emails
+                result = service.users().messages().list(
+                    userId='me',
+                    q=search_query,
+                    maxResults=min(500, max_emails - found),
+                    pageToken=page_token,
+                    fields='messages/id,nextPageToken'
+                ).execute()
+            except Exception as e:
+                logger.error(f"Search error: {e}")
+                return
+            
+            messages = result.get('messages', [])
+            if not messages:
+                return
+            
+            found += len(messages)
+            yield [msg['id'] for msg in messages]
+            
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return
+    
+    def iter_message_ids(self, search_query, max_emails=5000):
+        """Yield ids of emails matching a search query page by page, up to max_emails"""
+        for page in self.iter_message_id_pages(search_query, max_emails):
+            yield from page
+    
+    def _process_query_pipelined(self, search_query, max_emails, build_request):
+        """List matching ids on this thread while workers process the pages already listed
+        
+        Used by recover_by_query, where nothing needs the full id list first. Processing
+        while paging shifts Gmail's page tokens, so a final sweep catches skipped matches.
+        Query deletion resolves all ids up front instead, for its undo point.
+        Returns (total, successful, failed, errors).
+        """
+        pages = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        results = []
+        results_lock = threading.Lock()
+        
+        def worker():
+            while True:
+                item = pages.get()
+                if item is None:
+                    return
+                batch_number, batch_ids = item
+                error = self._execute_batch(batch_number, batch_ids, build_request)
+                with results_lock:
+                    results.append((batch_ids, error))
+        
+        def hand_off(item):
+            """Queue an item for the workers; False once none is left to take it"""
+            while any(thread.is_alive() for thread in workers):
+                try:
+                    pages.put(item, timeout=PIPELINE_PUT_TIMEOUT)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(PIPELINE_WORKERS)]
+        for thread in workers:
+            thread.start()
+        
+        seen = set()
+        batch_number = 0
+        try:
+            for page in self.iter_message_id_pages(search_query, max_emails):
+                page = [msg_id for msg_id in page if msg_id not in seen]
+                seen.update(page)
+                if page:
+                    batch_number += 1
+                    if not hand_off((batch_number, page)):
+                        logger.error(f"No pipeline worker left for user {self.user.username}; stopping at batch {batch_number}")
+                        results.append((page, {
+                            'batch': batch_number,
+                            'error': 'Batch workers stopped',
+                            'message_count': len(page)
+                        }))
+                        break
+        finally:
+            for _ in workers:
+                hand_off(None)
+            for thread in workers:
+                thread.join()
+        
+        # Processed messages drop out of the query while it is being paged, which can
+        # push later matches past the page tokens; sweep up anything that was skipped.
+        # A single page (or reaching max_emails) leaves nothing to sweep
+        if batch_number > 1 and len(seen) < max_emails:
+            leftover = [msg_id for msg_id in self.iter_message_ids(search_query, max_emails - len(seen)) if msg_id not in seen]
+            for i in range(0, len(leftover), 1000):
+                batch_ids = leftover[i:i + 1000]
+                seen.update(batch_ids)
+                batch_number += 1
+                results.append((batch_ids, self._execute_batch(batch_number, batch_ids, build_request)))
+        
+        successful = sum(len(batch_ids) for batch_ids, error in results if not error)
+        errors = sorted((error for _, error in results if error), key=lambda error: error['batch'])
+        logger.info(f"Fast batch complete: {batch_number} batches, {successful} emails for user {self.user.username}")
+        return len(seen), successful, len(seen) - successful, errors
+    
+    def find_message_ids(self, search_query, max_emails=5000):
+        """Collect ids of emails matching a search query, up to max_emails"""
+        all_message_ids = list(self.iter_message_ids(search_query, max_emails))
+        logger.info(f"Found {len(all_message_ids)} emails for query: {search_query}")
+        return all_message_ids
+    
+    def message_summaries(self, message_ids):
+        """Snapshot sender, subject and date of emails through batched metadata requests"""
+        summaries = []
+        for message in fetch_messages_metadata(self.service_manager.get_service(), message_ids,
+                                               http_factory=self.service_manager.authorized_http, user_id=self.user.id):
+            headers = extract_headers(message)
+            summaries.append({
+                'id': message['id'],
+                'from': headers['From'],
+                'subject': headers['Subject'],
+                'date': headers['Date']
+            })
+        return summaries
+    
+    def delete_by_query(self, search_query, max_emails=5000, permanent=False, message_ids=None, with_metadata=False):
+        """Delete emails by search query instead of individual IDs
+        
+        All matching ids are listed before anything is deleted: trashing while paging
+        shifts Gmail's page tokens. Pass message_ids when the query has already been
+        resolved (e.g. for an undo point) to skip the search. With with_metadata, the
+        result also carries a 'metadata' snapshot of the matched emails.
+        """
         try:
             service = self.service_manager.get_service()
             if not service:
                 return {'error': 'Gmail service not available'}
             
-            # Step 1: Search for emails matching query
-            all_message_ids = []
-            page_token = None
+            if message_ids is None:
+                message_ids = self.find_message_ids(search_query, max_emails)
             
-            while len(all_message_ids) < max_emails:
-                try:
-                    # Search emails
-                    result = service.users().messages().list(
-                        userId='me',
-                        q=search_query,
-                        maxResults=min(500, max_emails - len(all_message_ids)),
-                        pageToken=page_token
-                    ).execute()
-                    
-                    messages = result.get('messages', [])
-                    if not messages:
-                        break
-                    
-                    # Extract message IDs
-                    message_ids = [msg['id'] for msg in messages]
-                    all_message_ids.extend(message_ids)
-                    
-                    page_token = result.get('nextPageToken')
-                    if not page_token:
-                        break
-                        
-                except Exception as e:
-                    logger.error(f"Search error: {e}")
-                    break
+            if message_ids:
+                metadata = self.message_summaries(message_ids) if with_metadata else None
+                # Query resolved: delete using fast batch method
+                result = self.fast_batch_delete_emails(message_ids, permanent)
+                if metadata is not None and 'error' not in result:
+                    result['metadata'] = metadata
+                return result
             
-            logger.info(f"Found {len(all_message_ids)} emails for query: {search_query}")
-            
-            # Step 2: Delete using fast batch method
-            if all_message_ids:
-                return self.fast_batch_delete_emails(all_message_ids, permanent)
-            else:
-                return {
-                    'status': 'completed',
-                    'total': 0,
-                    'successful': 0,
-                    'failed': 0,
-                    'message': 'No emails found matching the query'
-                }
+            return {
+                'status': 'completed',
+                'total': 0,
+                'successful': 0,
+                'failed': 0,
+                'message': 'No emails found matching the query'
+            }
                 
         except Exception as e:
             logger.error(f"Delete by query error: {e}")
@@ -302,42 +485,20 @@ class EmailDeletionManager:
             if not service:
                 return {'error': 'Gmail service not available'}
             
-            # Search in trash
-            trash_query = f"in:trash {search_query}"
+            # Recover each page of trash matches while the next one is being listed
+            total, successful, failed, errors = self._process_query_pipelined(
+                f"in:trash {search_query}", max_emails, self._recover_request_builder(service)
+            )
             
-            # Step 1: Search for emails in trash
-            all_message_ids = []
-            page_token = None
-            
-            while len(all_message_ids) < max_emails:
-                try:
-                    result = service.users().messages().list(
-                        userId='me',
-                        q=trash_query,
-                        maxResults=min(500, max_emails - len(all_message_ids)),
-                        pageToken=page_token
-                    ).execute()
-                    
-                    messages = result.get('messages', [])
-                    if not messages:
-                        break
-                    
-                    message_ids = [msg['id'] for msg in messages]
-                    all_message_ids.extend(message_ids)
-                    
-                    page_token = result.get('nextPageToken')
-                    if not page_token:
-                        break
-                        
-                except Exception as e:
-                    logger.error(f"Trash search error: {e}")
-                    break
-            
-            logger.info(f"Found {len(all_message_ids)} emails in trash for query: {trash_query}")
-            
-            # Step 2: Recover using fast batch method
-            if all_message_ids:
-                return self.fast_batch_recover_emails(all_message_ids)
+            if total:
+                return {
+                    'status': 'completed',
+                    'total': total,
+                    'successful': successful,
+                    'failed': failed,
+                    'errors': errors,
+                    'action': 'recovered_from_trash'
+                }
             else:
                 return {
                     'status': 'completed',
@@ -353,29 +514,81 @@ class EmailDeletionManager:
 
 
 
+# Tasks for the same user on a worker share one manager (service, credentials and
+# quota pacing) for a few minutes instead of rebuilding it per task. Managers are
+# kept per thread, since their HTTP transports are not thread-safe. A reused manager
+# rebuilds its service once the user's token changes anywhere (credentials_generation)
+MANAGER_REUSE_SECONDS = 300
+_manager_cache = threading.local()
+
+def deletion_manager_for(user):
+    """Get this worker's recent EmailDeletionManager for a user, or build a new one"""
+    managers = _manager_cache.__dict__.setdefault('managers', {})
+    now = time.monotonic()
+    entry = managers.get(user.id)
+    if entry and now - entry[0] < MANAGER_REUSE_SECONDS and not entry[1].service_manager.auth_failed:
+        return entry[1]
+    manager = EmailDeletionManager(user)
+    managers[user.id] = (now, manager)
+    return manager
+
+@worker_process_init.connect
+def _reset_manager_cache(**kwargs):
+    # Forked pool processes must not share the parent's HTTP connections
+    _manager_cache.__dict__.pop('managers', None)
+
+
+PROGRESS_UPDATE_INTERVAL = 0.5
+
+def throttled_progress(task, verb, interval=PROGRESS_UPDATE_INTERVAL):
+    """Build a progress callback that writes task state at most once per interval"""
+    last_update = [0.0]
+    
+    def report_progress(processed, total):
+        now = time.monotonic()
+        if processed < total and now - last_update[0] < interval:
+            return
+        last_update[0] = now
+        task.update_state(state='PROGRESS', meta={
+            'current': processed,
+            'total': total,
+            'message': f'{verb} {processed} of {total} emails'
+        })
+    
+    return report_progress
+
+
 @shared_task(bind=True)
-def delete_by_query_task(self, user_id, search_query, max_emails=5000, permanent=False):
+def delete_by_query_task(self, user_id, search_query, max_emails=5000, permanent=False, with_metadata=False):
     """Delete emails by search query with undo tracking"""
     try:
         from .advanced_operations import UndoManager
         user = User.objects.get(id=user_id)
-        deletion_manager = EmailDeletionManager(user)
+        deletion_manager = deletion_manager_for(user)
+        
+        # Resolve the query first so the undo point records the exact ids
+        message_ids = deletion_manager.find_message_ids(search_query, max_emails)
         
         # Create undo point BEFORE deletion
         undo_manager = UndoManager(user)
         undo_data = {
             'type': 'bulk_delete_query',
             'search_query': search_query,
+            'message_ids': message_ids,
             'max_emails': max_emails,
             'permanent': permanent
         }
+        if with_metadata and message_ids:
+            # Snapshot what is about to be deleted with the undo point, so it is never re-fetched
+            undo_data['metadata'] = deletion_manager.message_summaries(message_ids)
         undo_result = undo_manager.create_undo_point(undo_data)
         
         # Execute deletion
         result = deletion_manager.delete_by_query(
             search_query=search_query,
             max_emails=max_emails,
-            permanent=permanent
+            permanent=permanent,
+            message_ids=message_ids
         )
         
         # Add undo_id to result
@@ -396,13 +609,25 @@ def delete_by_query_task(self, user_id, search_query, max_emails=5000, permanent
 
 
 
+# Larger bulk deletions are split into sub-tasks of this many ids so several workers share them
+BULK_DELETE_CHUNK_SIZE = 5000
+
 @shared_task(bind=True) 
-def bulk_delete_emails_task(self, user_id, message_ids, permanent=False, batch_size=1000):
-    """Fast bulk deletion with undo tracking"""
+def bulk_delete_emails_task(self, user_id, message_ids=None, permanent=False, batch_size=1000, search_query=None, max_emails=5000):
+    """Fast bulk deletion with undo tracking
+    
+    Pass search_query instead of message_ids to resolve the ids inside the worker,
+    keeping large id lists out of the broker payload.
+    """
     try:
         from .advanced_operations import UndoManager
         user = User.objects.get(id=user_id)
-        deletion_manager = EmailDeletionManager(user)
+        deletion_manager = deletion_manager_for(user)
+        
+        if message_ids is None and search_query:
+            # Ids are listed in full before deleting: trashing while paging shifts Gmail's page tokens
+            message_ids = deletion_manager.find_message_ids(search_query, max_emails)
+        message_ids = clean_message_ids(message_ids or [])
         
         # Create undo point BEFORE deletion
         undo_manager = UndoManager(user)
@@ -412,17 +637,35 @@ def bulk_delete_emails_task(self, user_id, message_ids, permanent=False, batch_s
             'permanent': permanent
         }
         undo_result = undo_manager.create_undo_point(undo_data)
+        undo_id = undo_result.get('undo_id') if 'error' not in undo_result else None
         
-        # Execute deletion
+        if len(message_ids) > BULK_DELETE_CHUNK_SIZE:
+            # Fan chunks out across workers; the chord callback takes over this task's id
+            self.update_state(state='PROGRESS', meta={
+                'current': 0,
+                'total': len(message_ids),
+                'message': f'Deleted 0 of {len(message_ids)} emails'
+            })
+            cache.set(f"bulk_delete_progress_{self.request.id}", 0, 3600)
+            header = group(
+                bulk_delete_chunk_task.s(user_id, message_ids[i:i + BULK_DELETE_CHUNK_SIZE], permanent, batch_size, self.request.id, len(message_ids))
+                for i in range(0, len(message_ids), BULK_DELETE_CHUNK_SIZE)
+            )
+            raise self.replace(chord(header, aggregate_bulk_delete_results.s(user_id, len(message_ids), permanent, undo_id)))
+        
+        report_progress = throttled_progress(self, 'Deleted')
+        
+        # Execute deletion, reporting progress once per batch
         result = deletion_manager.fast_batch_delete_emails(
             message_ids, 
             permanent=permanent, 
-            batch_size=batch_size
+            batch_size=batch_size,
+            progress_callback=report_progress
         )
         
         # Add undo_id to result
-        if 'error' not in result and 'error' not in undo_result:
-            result['undo_id'] = undo_result.get('undo_id')
+        if 'error' not in result and undo_id:
+            result['undo_id'] = undo_id
         
         # Track statistics
         if 'error' not in result:
@@ -430,41 +673,91 @@ def bulk_delete_emails_task(self, user_id, message_ids, permanent=False, batch_s
         
         return result
         
+    except Ignore:
+        # Raised by self.replace() once the chunked chord has been dispatched
+        raise
     except User.DoesNotExist:
         return {'status': 'error', 'message': 'User not found'}
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
 
+@shared_task(bind=True)
+def bulk_delete_chunk_task(self, user_id, message_ids, permanent, batch_size, parent_task_id, grand_total):
+    """Delete one chunk of a bulk deletion, reporting progress on the parent task"""
+    try:
+        user = User.objects.get(id=user_id)
+        deletion_manager = deletion_manager_for(user)
+        progress_key = f"bulk_delete_progress_{parent_task_id}"
+        reported = [0]
+        
+        def report_progress(processed, total):
+            # Chunks run concurrently, so the shared count lives in the cache. Progress is
+            # best effort: a failure here must not stop the chunk's remaining batches
+            try:
+                # The counter can expire or be evicted while chunks wait in the queue
+                cache.add(progress_key, 0, 3600)
+                current = cache.incr(progress_key, processed - reported[0])
+                reported[0] = processed
+                self.update_state(task_id=parent_task_id, state='PROGRESS', meta={
+                    'current': current,
+                    'total': grand_total,
+                    'message': f'Deleted {current} of {grand_total} emails'
+                })
+            except Exception as e:
+                logger.warning(f"Bulk delete progress update failed for task {parent_task_id}: {e}")
+        
+        result = deletion_manager.fast_batch_delete_emails(
+            message_ids,
+            permanent=permanent,
+            batch_size=batch_size,
+            progress_callback=report_progress
+        )
+        if 'error' in result:
+            return {'total': len(message_ids), 'successful': 0, 'failed': len(message_ids), 'errors': [result['error']]}
+        return result
+        
+    except Exception as e:
+        logger.error(f"Bulk delete chunk error: {e}")
+        return {'total': len(message_ids), 'successful': 0, 'failed': len(message_ids), 'errors': [str(e)]}
+
+@shared_task
+def aggregate_bulk_delete_results(results, user_id, total, permanent, undo_id=None):
+    """Celery chord callback combining the chunks of a bulk deletion"""
+    result = {
+        'status': 'completed',
+        'total': total,
+        'successful': sum(r.get('successful', 0) for r in results),
+        'failed': sum(r.get('failed', 0) for r in results),
+        'errors': [error for r in results for error in r.get('errors', [])],
+        'action': 'permanently_deleted' if permanent else 'moved_to_trash'
+    }
+    if undo_id:
+        result['undo_id'] = undo_id
+    
+    track_deletion_stats(user_id, result)
+    return result
 
 
+
+# Average email size used to estimate the storage a deletion freed
+AVERAGE_EMAIL_SIZE_KB = 50
+DELETION_STATS_SECONDS = 86400 * 30
+
+def deletion_stats_keys(user_id, days_back=30):
+    """Cache keys of the (total_deleted, deletion_sessions) counters"""
+    prefix = f"deletion_stats_{user_id}_{days_back}"
+    return f"{prefix}_total_deleted", f"{prefix}_sessions"
+
 def track_deletion_stats(user_id, deletion_result):
-    """Track deletion statistics"""
+    """Track deletion statistics with atomic counters, safe across concurrent workers"""
     try:
-        from django.core.cache import cache
-        
-        # Get current stats
-        cache_key = f"deletion_stats_{user_id}_30"
-        stats = cache.get(cache_key, {
-            'total_deleted': 0,
-            'storage_saved_mb': 0,
-            'deletion_sessions': 0,
-            'most_deleted_category': 'promotions',
-            'avg_emails_per_session': 0
-        })
-        
-        # Update stats
         successful = deletion_result.get('successful', 0)
-        stats['total_deleted'] += successful
-        stats['deletion_sessions'] += 1
-        stats['avg_emails_per_session'] = stats['total_deleted'] / stats['deletion_sessions']
-        
-        # Estimate storage saved (rough calculation)
-        # Average email size ~50KB
-        storage_saved_kb = successful * 50
-        stats['storage_saved_mb'] += round(storage_saved_kb / 1024, 2)
+        total_key, sessions_key = deletion_stats_keys(user_id)
         
-        # Save updated stats
-        cache.set(cache_key, stats, 86400 * 30)  # Cache for 30 days
+        # Counters start when the first deletion in the window is recorded
+        for key, amount in ((total_key, successful), (sessions_key, 1)):
+            cache.add(key, 0, DELETION_STATS_SECONDS)
+            cache.incr(key, amount)
         
         logger.info(f"Updated deletion stats for user {user_id}: +{successful} emails")
         
@@ -478,13 +771,18 @@ def track_deletion_stats(user_id, deletion_result):
 def bulk_recover_emails_task(self, user_id, message_ids, batch_size=1000):
     """Fast bulk recovery using batchModify"""
     try:
+        message_ids = clean_message_ids(message_ids)
         user = User.objects.get(id=user_id)
-        deletion_manager = EmailDeletionManager(user)
+        deletion_manager = deletion_manager_for(user)
         
-        # Use the fast batch recovery method
+        report_progress = throttled_progress(self, 'Recovered')
+        
+        # Removing only TRASH keeps each message's own labels, so up to batch_size
+        # ids are recovered per batchModify call
         result = deletion_manager.fast_batch_recover_emails(
-            message_ids, 
-            batch_size=batch_size
+            message_ids,
+            batch_size,
+            progress_callback=report_progress
         )
         
         return result
@@ -502,7 +800,7 @@ def recover_by_query_task(self, user_id, search_query, max_emails=5000):
     """Recover emails by search query"""
     try:
         user = User.objects.get(id=user_id)
-        deletion_manager = EmailDeletionManager(user)
+        deletion_manager = deletion_manager_for(user)
         
         result = deletion_manager.recover_by_query(
             search_query=search_query,
@@ -1,10 +1,28 @@
+import hashlib
 import logging
+from functools import lru_cache
 from typing import List
+from django.core.cache import cache
 from googleapiclient.errors import HttpError
-from .gmail_utils import GmailServiceManager, handle_gmail_api_error, retry_gmail_operation
+from .gmail_utils import GmailServiceManager, handle_gmail_api_error, retry_gmail_operation, fetch_messages_metadata, extract_headers, listing_version, profile_cache_key
 
 logger = logging.getLogger(__name__)
 
+# Paging back and forth through the same listing reuses results for this long
+LISTING_CACHE_SECONDS = 45
+LABELS_CACHE_SECONDS = 600
+
+def labels_cache_key(user_id):
+    return f"gmail_labels_{user_id}"
+
+def organize_labels(labels):
+    """Split a labels.list response into the all/system/user groups the labels view returns"""
+    return {
+        'all_labels': labels,
+        'system_labels': [l for l in labels if l['type'] == 'system'],
+        'user_labels': [l for l in labels if l['type'] == 'user']
+    }
+
 class GmailOperations:
     """Class for Gmail email operations"""
     
@@ -12,9 +30,43 @@ class GmailOperations:
         self.user = user
         self.service_manager = GmailServiceManager(user)
     
+    def _listing_cache_key(self, kind, *params):
+        # The version moves whenever this user's messages are deleted or recovered
+        digest = hashlib.blake2b(repr(params).encode(), digest_size=16).hexdigest()
+        return f"gmail_{kind}_{self.user.id}_{listing_version(self.user.id)}_{digest}"
+    
+    def listing_etag(self, *params):
+        """ETag for a listing page: changes with the mailbox's Gmail historyId or our own changes
+        
+        The historyId comes from the profile cached for a minute, so checking it usually
+        costs no Gmail call. New mail therefore changes the tag only once that profile
+        expires: a revalidation can get a 304 for up to 60 seconds after mail arrives,
+        about the same window as the listing cache. Our own deletions and recoveries bump
+        listing_version and change it at once. Returns None when the profile can't be fetched.
+        """
+        try:
+            profile = cache.get(profile_cache_key(self.user.id))
+            if profile is None:
+                service = self.service_manager.get_service()
+                if not service:
+                    return None
+                profile = retry_gmail_operation(lambda: service.users().getProfile(userId='me').execute())
+                cache.set(profile_cache_key(self.user.id), profile, 60)
+            
+            digest = hashlib.blake2b(repr(params).encode(), digest_size=8).hexdigest()
+            return f'"{profile.get("historyId")}-{listing_version(self.user.id)}-{digest}"'
+        except Exception as e:
+            logger.warning(f"Could not compute listing ETag for user {self.user.username}: {e}")
+            return None
+    
     def list_emails(self, query='', max_results=50, page_token=None, label_ids=None):
         """List emails with optional query and pagination"""
         try:
+            cache_key = self._listing_cache_key('list', query, max_results, page_token, label_ids)
+            cached_result = cache.get(cache_key)
+            if cached_result is not None:
+                return cached_result
+            
             service = self.service_manager.get_service()
             if not service:
                 return {'error': 'Gmail service not available'}
@@ -23,7 +75,8 @@ class GmailOperations:
             params = {
                 'userId': 'me',
                 'maxResults': min(max_results, 500),  # Gmail API limit
-                'q': query if query else ''
+                'q': query if query else '',
+                'fields': 'messages(id,threadId),nextPageToken,resultSizeEstimate'
             }
             
             if page_token:
@@ -43,12 +96,14 @@ class GmailOperations:
             
             logger.info(f"Listed {len(messages)} emails for user {self.user.username}")
             
-            return {
+            result = {
                 'messages': messages,
                 'nextPageToken': next_page_token,
                 'resultSizeEstimate': result_size_estimate,
                 'query': query
             }
+            cache.set(cache_key, result, LISTING_CACHE_SECONDS)
+            return result
             
         except HttpError as e:
             error_info = handle_gmail_api_error(e, "list emails")
@@ -68,52 +123,23 @@ class GmailOperations:
             if not message_ids:
                 return {'emails': []}
             
-            # Limit batch size to avoid API limits
-            batch_size = 100
             all_emails = []
-            
-            for i in range(0, len(message_ids), batch_size):
-                batch_ids = message_ids[i:i + batch_size]
+            for message in fetch_messages_metadata(service, message_ids, http_factory=self.service_manager.authorized_http, user_id=self.user.id):
+                # Extract metadata
+                headers = extract_headers(message)
                 
-                def fetch_batch():
-                    batch_emails = []
-                    for msg_id in batch_ids:
-                        try:
-                            message = service.users().messages().get(
-                                userId='me', 
-                                id=msg_id,
-                                format='metadata',
-                                metadataHeaders=['From', 'To', 'Subject', 'Date']
-                            ).execute()
-                            
-                            # Extract metadata
-                            headers = {h['name']: h['value'] for h in message.get('payload', {}).get('headers', [])}
-                            
-                            email_data = {
-                                'id': message['id'],
-                                'thread_id': message.get('threadId'),
-                                'label_ids': message.get('labelIds', []),
-                                'snippet': message.get('snippet', ''),
-                                'from': headers.get('From', 'Unknown'),
-                                'to': headers.get('To', 'Unknown'), 
-                                'subject': headers.get('Subject', 'No Subject'),
-                                'date': headers.get('Date', 'Unknown'),
-                                'size_estimate': message.get('sizeEstimate', 0),
-                                'internal_date': message.get('internalDate')
-                            }
-                            
-                            batch_emails.append(email_data)
-                            
-                        except HttpError as e:
-                            if e.resp.status == 404:
-                                logger.warning(f"Message {msg_id} not found, skipping")
-                                continue
-                            raise
-                    
-                    return batch_emails
-                
-                batch_result = retry_gmail_operation(fetch_batch)
-                all_emails.extend(batch_result)
+                all_emails.append({
+                    'id': message['id'],
+                    'thread_id': message.get('threadId'),
+                    'label_ids': message.get('labelIds', []),
+                    'snippet': message.get('snippet', ''),
+                    'from': headers['From'],
+                    'to': headers['To'], 
+                    'subject': headers['Subject'],
+                    'date': headers['Date'],
+                    'size_estimate': message.get('sizeEstimate', 0),
+                    'internal_date': message.get('internalDate')
+                })
             
             logger.info(f"Retrieved metadata for {len(all_emails)} emails for user {self.user.username}")
             
@@ -130,6 +156,11 @@ class GmailOperations:
     def search_emails(self, query, max_results=20, page_token=None):
         """Search emails using Gmail query syntax"""
         try:
+            cache_key = self._listing_cache_key('search', query, max_results, page_token)
+            cached_result = cache.get(cache_key)
+            if cached_result is not None:
+                return cached_result
+            
             service = self.service_manager.get_service()
             if not service:
                 return {'error': 'Gmail service not available'}
@@ -138,7 +169,8 @@ class GmailOperations:
             request_params = {
                 'userId': 'me',
                 'q': query,
-                'maxResults': max_results
+                'maxResults': max_results,
+                'fields': 'messages/id,nextPageToken,resultSizeEstimate'
             }
             
             if page_token:
@@ -150,51 +182,45 @@ class GmailOperations:
             next_page_token = result.get('nextPageToken')
             result_size_estimate = result.get('resultSizeEstimate', 0)
             
-            # Get detailed message information
+            # Get detailed message information in batched requests
             detailed_messages = []
-            for msg in messages:
-                try:
-                    message = service.users().messages().get(
-                        userId='me', 
-                        id=msg['id'],
-                        format='metadata',
-                        metadataHeaders=['From', 'To', 'Subject', 'Date']
-                    ).execute()
-                    
-                    # Extract headers
-                    headers = {}
-                    for header in message.get('payload', {}).get('headers', []):
-                        headers[header['name']] = header['value']
-                    
-                    detailed_messages.append({
-                        'id': message['id'],
-                        'threadId': message['threadId'],
-                        'labelIds': message.get('labelIds', []),
-                        'snippet': message.get('snippet', ''),
-                        'from': headers.get('From', 'Unknown'),
-                        'to': headers.get('To', 'Unknown'),
-                        'subject': headers.get('Subject', 'No Subject'),
-                        'date': headers.get('Date', 'Unknown'),
-                        'sizeEstimate': message.get('sizeEstimate', 0)
-                    })
-                except Exception as e:
-                    logger.warning(f"Failed to get message details for {msg['id']}: {e}")
-                    continue
-            
-            return {
+            for message in fetch_messages_metadata(service, [msg['id'] for msg in messages], http_factory=self.service_manager.authorized_http, user_id=self.user.id):
+                # Extract headers
+                headers = extract_headers(message)
+                
+                detailed_messages.append({
+                    'id': message['id'],
+                    'threadId': message['threadId'],
+                    'labelIds': message.get('labelIds', []),
+                    'snippet': message.get('snippet', ''),
+                    'from': headers['From'],
+                    'to': headers['To'],
+                    'subject': headers['Subject'],
+                    'date': headers['Date'],
+                    'sizeEstimate': message.get('sizeEstimate', 0)
+                })
+            
+            result = {
                 'messages': detailed_messages,
                 'nextPageToken': next_page_token,
                 'resultSizeEstimate': result_size_estimate,
                 'query': query
             }
+            cache.set(cache_key, result, LISTING_CACHE_SECONDS)
+            return result
             
         except Exception as e:
             logger.error(f"Search emails error: {e}")
             return {'error': str(e)}
     
     def get_labels(self):
-        """Get all Gmail labels"""
+        """Get all Gmail labels, cached per user since they rarely change"""
         try:
+            cache_key = labels_cache_key(self.user.id)
+            cached_labels = cache.get(cache_key)
+            if cached_labels is not None:
+                return cached_labels
+            
             service = self.service_manager.get_service()
             if not service:
                 return {'error': 'Gmail service not available'}
@@ -205,17 +231,12 @@ class GmailOperations:
             result = retry_gmail_operation(fetch_labels)
             labels = result.get('labels', [])
             
-            # Organize labels by type
-            system_labels = [l for l in labels if l['type'] == 'system']
-            user_labels = [l for l in labels if l['type'] == 'user']
-            
             logger.info(f"Retrieved {len(labels)} labels for user {self.user.username}")
             
-            return {
-                'all_labels': labels,
-                'system_labels': system_labels,
-                'user_labels': user_labels
-            }
+            result = organize_labels(labels)
+            cache.set(cache_key, result, LABELS_CACHE_SECONDS)
+            
+            return result
             
         except HttpError as e:
             error_info = handle_gmail_api_error(e, "get labels")
@@ -228,6 +249,12 @@ class GmailOperations:
     def get_accurate_email_count(self, query, max_count=10000):
         """Get accurate email count by actually fetching pages"""
         try:
+            # Repeated previews of the same query reuse a recent count
+            cache_key = self._listing_cache_key('count', query)
+            cached_count = cache.get(cache_key)
+            if cached_count is not None:
+                return cached_count
+            
             service = self.service_manager.get_service()
             if not service:
                 return {'error': 'Gmail service not available'}
@@ -243,7 +270,8 @@ class GmailOperations:
                         userId='me',
                         q=query,
                         maxResults=500,  # Max per page
-                        pageToken=page_token
+                        pageToken=page_token,
+                        fields='messages/id,nextPageToken'  # Only ids are needed for counting
                     ).execute()
                     
                     messages = result.get('messages', [])
@@ -259,7 +287,9 @@ class GmailOperations:
                     page_token = result.get('nextPageToken')
                     if not page_token:
                         # No more pages - we have the exact count
-                        return {'count': total_count, 'is_estimate': False}
+                        result = {'count': total_count, 'is_estimate': False}
+                        cache.set(cache_key, result, 60)
+                        return result
                         
                 except Exception as e:
                     logger.error(f"Error getting email count: {e}")
@@ -267,7 +297,9 @@ class GmailOperations:
             
             # If we hit the page limit, it's an estimate
             is_estimate = pages_checked >= max_pages
-            return {'count': total_count, 'is_estimate': is_estimate}
+            result = {'count': total_count, 'is_estimate': is_estimate}
+            cache.set(cache_key, result, 60)
+            return result
             
         except Exception as e:
             logger.error(f"Count emails error: {e}")
@@ -284,7 +316,8 @@ class GmailOperations:
             result = service.users().messages().list(
                 userId='me',
                 q=query,
-                maxResults=1
+                maxResults=1,
+                fields='resultSizeEstimate'
             ).execute()
             
             estimate = result.get('resultSizeEstimate', 0)
@@ -295,7 +328,8 @@ class GmailOperations:
                 exact_result = service.users().messages().list(
                     userId='me',
                     q=query,
-                    maxResults=100
+                    maxResults=100,
+                    fields='messages/id'
                 ).execute()
                 
                 messages = exact_result.get('messages', [])
@@ -310,47 +344,54 @@ class GmailOperations:
             logger.error(f"Quick estimate error: {e}")
             return {'error': str(e)}
 
+# Filter key -> Gmail query fragment, in the order they appear in the query
+_QUERY_FORMATTERS = (
+    ('older_than_days', 'older_than:{}d'),
+    ('newer_than_days', 'newer_than:{}d'),
+    ('larger_than_mb', 'larger:{}M'),
+    ('smaller_than_mb', 'smaller:{}M'),
+    ('from_email', 'from:{}'),
+)
+
+# Boolean filter key -> (fragment when True, fragment when False)
+_QUERY_FLAGS = (
+    ('is_read', '-is:unread', 'is:unread'),
+    ('has_attachment', 'has:attachment', '-has:attachment'),
+)
+
 def build_search_query(filters):
-    """Build Gmail search query from filter parameters"""
-    query_parts = []
-    
-    # Date filters
-    if filters.get('older_than_days'):
-        query_parts.append(f"older_than:{filters['older_than_days']}d")
-    
-    if filters.get('newer_than_days'):
-        query_parts.append(f"newer_than:{filters['newer_than_days']}d")
-    
-    # Size filters
-    if filters.get('larger_than_mb'):
-        query_parts.append(f"larger:{filters['larger_than_mb']}M")
-    
-    if filters.get('smaller_than_mb'):
-        query_parts.append(f"smaller:{filters['smaller_than_mb']}M")
-    
-    # Sender filters
-    if filters.get('from_email'):
-        query_parts.append(f"from:{filters['from_email']}")
+    """Build Gmail search query from filter parameters, memoized per distinct filter set"""
+    # Value types are part of the key, since 1 == True would otherwise share an entry
+    items = tuple(sorted(
+        (key, type(value).__name__, tuple(value) if isinstance(value, list) else value)
+        for key, value in filters.items()
+    ))
+    try:
+        return _build_search_query_cached(items)
+    except TypeError:
+        # Unhashable filter values can't be memoized
+        return _build_search_query(filters)
+
+@lru_cache(maxsize=512)
+def _build_search_query_cached(items):
+    return _build_search_query({key: value for key, _, value in items})
+
+def _build_search_query(filters):
+    query_parts = [fmt.format(value) for key, fmt in _QUERY_FORMATTERS if (value := filters.get(key))]
     
     # Label filters
-    if filters.get('labels'):
-        for label in filters['labels']:
-            query_parts.append(f"label:{label}")
-    
-    # Read status
-    if filters.get('is_read') == True:
-        query_parts.append("-is:unread")
-    elif filters.get('is_read') == False:
-        query_parts.append("is:unread")
+    query_parts.extend(f"label:{label}" for label in filters.get('labels') or ())
     
-    # Attachment filter
-    if filters.get('has_attachment') == True:
-        query_parts.append("has:attachment")
-    elif filters.get('has_attachment') == False:
-        query_parts.append("-has:attachment")
+    # Read status and attachment filters
+    for key, when_true, when_false in _QUERY_FLAGS:
+        value = filters.get(key)
+        if value == True:
+            query_parts.append(when_true)
+        elif value == False:
+            query_parts.append(when_false)
     
     # Subject filter
-    if filters.get('subject_contains'):
-        query_parts.append(f"subject:{filters['subject_contains']}")
+    if subject := filters.get('subject_contains'):
+        query_parts.append(f"subject:{subject}")
     
-    return ' '.join(query_parts)
\ No newline at end of file
+    return ' '.join(query_parts)
@@ -1,47 +1,179 @@
 import logging
+import random
+import socket
+import ssl
 import time
+import threading
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional, Dict, Any
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from functools import lru_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
 from google.auth.exceptions import RefreshError
+from google_auth_httplib2 import AuthorizedHttp
 from .models import GoogleOAuthToken
-from .utils import get_credentials_for_user
-from datetime import datetime
+from email.utils import parsedate_to_datetime
 
 logger = logging.getLogger(__name__)
 
+# Gmail accepts up to 100 sub-requests per batch HTTP call, but rate limits batches
+# larger than 50, which only turns into per-message retries
+GMAIL_BATCH_SIZE = 50
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date']
+# Partial response: only the parts of a message the metadata views read
+METADATA_FIELDS = 'id,threadId,labelIds,snippet,sizeEstimate,internalDate,payload/headers'
+HEADER_DEFAULTS = {'From': 'Unknown', 'To': 'Unknown', 'Subject': 'No Subject', 'Date': 'Unknown'}
+# Concurrent requests per user, kept low to stay within Gmail's per-user quota
+GMAIL_MAX_WORKERS = getattr(settings, 'GMAIL_MAX_WORKERS', 5)
+
+# Recently fetched message metadata keyed by (user_id, listing version, headers, message_id).
+# The listing version lives in the shared cache, so a change made in any process
+# (e.g. a Celery deletion) retires every process's entries for that user
+_metadata_cache = TTLCache(maxsize=2048, ttl=300)
+_metadata_cache_lock = threading.Lock()
+
+# Built Gmail services per thread, keyed by user id; httplib2 transports are not thread-safe
+_thread_local = threading.local()
+SERVICE_REUSE_SECONDS = 300
+
+# Failures retry_gmail_operation treats as transient; anything else is raised at once
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+TRANSIENT_NETWORK_ERRORS = (ConnectionError, socket.timeout, ssl.SSLError, httplib2.ServerNotFoundError)
+
+# Stored OAuth token fields are cached so bulk tasks skip the token SELECT
+CREDENTIALS_CACHE_SECONDS = 300
+CREDENTIALS_REFRESH_WINDOW_SECONDS = 600
+_credentials_refresh_lock = threading.Lock()
+TOKEN_CREDENTIAL_FIELDS = ('access_token', 'refresh_token', 'token_uri', 'client_id', 'client_secret', 'scopes', 'expiry')
+
+HTTP_TIMEOUT_SECONDS = 30
+
+# One pooled session for Google's OAuth endpoints: token refresh here, code exchange and
+# revocation in utils and tasks, all reusing keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=Retry(total=2, backoff_factor=0.2)))
+_token_refresh_request = Request(session=_SESSION)
+
+def thread_http():
+    """Return this thread's httplib2 transport, reused so its TLS connections stay open"""
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        http = _thread_local.http = httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS)
+    return http
+
+@lru_cache(maxsize=None)
+def gmail_discovery_document():
+    """Gmail discovery document bundled with googleapiclient, read once per process"""
+    return get_static_doc('gmail', 'v1')
+
+def build_gmail_service(credentials):
+    """Build a Gmail service from the preloaded discovery document on this thread's transport"""
+    return build_from_document(gmail_discovery_document(), http=AuthorizedHttp(credentials, http=thread_http()))
+
 class GmailServiceManager:
     """Manager class for Gmail API service operations"""
     
     def __init__(self, user):
         self.user = user
         self._service = None
+        self._credentials = None
         self._last_error = None
+        self._auth_failed = False
+        self._verified = False
+        self._generation = None
     
     def get_service(self, force_refresh=False):
         """Get Gmail service with proper token refresh"""
-        # Always get fresh credentials to ensure tokens are current
+        # Shared across processes, so a token changed by any web or Celery worker is noticed here
+        generation = credentials_generation(self.user.id)
+        
+        # Reuse the service built earlier in this manager's lifetime while its token is valid
+        if (self._service and not force_refresh and not self._auth_failed and not self._credentials.expired
+                and self._generation == generation):
+            return self._service
+        
+        # Reuse a service this thread built recently for the same user
+        thread_services = _thread_local.__dict__.setdefault('services', {})
+        cached = thread_services.get(self.user.id)
+        if cached and not force_refresh and not self._auth_failed:
+            service, credentials, built_at, built_generation = cached
+            if (not credentials.expired and time.monotonic() - built_at < SERVICE_REUSE_SECONDS
+                    and built_generation == generation):
+                self._service, self._credentials, self._generation = service, credentials, generation
+                return service
+        
         credentials = get_credentials_for_user(self.user)
         if not credentials:
+            thread_services.pop(self.user.id, None)
             return None
+        self._credentials = credentials
         
         try:
-            # Always create fresh service with current credentials
-            service = build('gmail', 'v1', credentials=credentials)
-            
-            # Test with lightweight call
-            service.users().getProfile(userId='me').execute()
+            # Create service with current credentials from the bundled discovery document;
+            # connectivity is checked by verify()
+            service = build_gmail_service(credentials)
             
             self._service = service
+            self._generation = generation
+            self._auth_failed = False
+            self._verified = False
+            thread_services[self.user.id] = (service, credentials, time.monotonic(), generation)
             return service
             
         except Exception as e:
             logger.error(f"Gmail service creation failed: {e}")
+            self._last_error = str(e)
             return None
     
+    def verify(self):
+        """Check the connection with a lightweight call, once per manager lifetime"""
+        if self._verified:
+            return True
+        
+        if not self.get_service():
+            return False
+        
+        try:
+            self._test_connection()
+            self._verified = True
+            return True
+        except HttpError as e:
+            if e.resp.status == 401:
+                self.invalidate()
+            logger.error(f"Gmail connection check failed for user {self.user.username}: {e}")
+            self._last_error = str(e)
+            return False
+        except Exception as e:
+            logger.error(f"Gmail connection check failed for user {self.user.username}: {e}")
+            self._last_error = str(e)
+            return False
+    
+    def invalidate(self):
+        """Force a rebuild with fresh credentials on the next get_service()"""
+        self._auth_failed = True
+        _thread_local.__dict__.get('services', {}).pop(self.user.id, None)
+        # A cached profile would report the connection as working
+        cache.delete(profile_cache_key(self.user.id))
+    
+    @property
+    def auth_failed(self):
+        return self._auth_failed
+    
+    def authorized_http(self):
+        """Authorized HTTP transport over the calling thread's own keep-alive connection"""
+        return AuthorizedHttp(self._credentials, http=thread_http())
+    
     def _test_connection(self):
         """Test Gmail API connection with minimal call"""
         if not self._service:
@@ -57,14 +189,14 @@ class GmailServiceManager:
         try:
             # Remove invalid tokens
             GoogleOAuthToken.objects.filter(user=self.user).delete()
+            invalidate_cached_credentials(self.user.id)
             logger.info(f"Removed invalid tokens for user {self.user.username}")
         except Exception as e:
             logger.error(f"Failed to clean up invalid tokens for user {self.user.username}: {e}")
     
     def is_connected(self):
         """Check if Gmail service is connected and working"""
-        service = self.get_service()
-        return service is not None
+        return self.verify()
     
     def get_last_error(self):
         """Get the last error that occurred"""
@@ -75,11 +207,15 @@ def create_gmail_service(user):
     manager = GmailServiceManager(user)
     return manager.get_service()
 
-def test_gmail_connectivity(user):
-    """Test Gmail connectivity and return detailed status"""
+def test_gmail_connectivity(user, force_refresh=False):
+    """Test Gmail connectivity and return detailed status
+    
+    This is the one place that probes Gmail up front; other callers build the
+    service without a round trip and let their real call surface errors.
+    """
     try:
         manager = GmailServiceManager(user)
-        service = manager.get_service()
+        service = manager.get_service(force_refresh=force_refresh)
         
         if not service:
             return {
@@ -110,11 +246,14 @@ def test_gmail_connectivity(user):
             'profile': None
         }
 
+ERROR_DETAILS_MAX_BYTES = 512
+
 def handle_gmail_api_error(error, operation="Gmail API operation"):
     """Handle Gmail API errors with appropriate responses"""
     if isinstance(error, HttpError):
         error_code = error.resp.status
-        error_content = error.content.decode('utf-8') if error.content else 'Unknown error'
+        # Error bodies can be large HTML pages; the start is enough to diagnose them
+        error_content = error.content[:ERROR_DETAILS_MAX_BYTES].decode('utf-8', errors='replace') if error.content else 'Unknown error'
         
         if error_code == 401:
             return {
@@ -159,33 +298,266 @@ def handle_gmail_api_error(error, operation="Gmail API operation"):
             'details': str(error)
         }
 
-def retry_gmail_operation(func, max_retries=3, delay=1):
-    """Retry Gmail operations with exponential backoff"""
+def _retry_after_seconds(error):
+    """Read a Retry-After header given either as seconds or as an HTTP date"""
+    value = error.resp.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - timezone.now()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def retry_gmail_operation(func, max_retries=3, delay=1, max_backoff=32, max_elapsed_time=60):
+    """Retry Gmail operations with jittered exponential backoff, honouring Retry-After"""
+    started = time.monotonic()
     for attempt in range(max_retries):
         try:
             return func()
         except HttpError as e:
-            if e.resp.status == 429:  # Rate limit
-                if attempt < max_retries - 1:
-                    sleep_time = delay * (2 ** attempt)
-                    logger.warning(f"Rate limited, retrying in {sleep_time} seconds (attempt {attempt + 1})")
+            # Only timeouts, rate limits and transient server errors are worth retrying
+            if e.resp.status not in RETRYABLE_STATUS_CODES:
+                raise
+            if attempt < max_retries - 1:
+                retry_after = _retry_after_seconds(e)
+                if retry_after is not None:
+                    sleep_time = retry_after + random.uniform(0, 0.3 * retry_after)
+                else:
+                    sleep_time = min(max_backoff, delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                if time.monotonic() - started + sleep_time <= max_elapsed_time:
+                    logger.warning(f"Gmail returned {e.resp.status}, retrying in {sleep_time:.2f} seconds (attempt {attempt + 1})")
                     time.sleep(sleep_time)
                     continue
             raise
-        except Exception as e:
+        except TRANSIENT_NETWORK_ERRORS as e:
             if attempt < max_retries - 1:
-                sleep_time = delay * (2 ** attempt)
-                logger.warning(f"Operation failed, retrying in {sleep_time} seconds: {e}")
-                time.sleep(sleep_time)
-                continue
+                sleep_time = min(max_backoff, delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                if time.monotonic() - started + sleep_time <= max_elapsed_time:
+                    logger.warning(f"Operation failed, retrying in {sleep_time:.2f} seconds: {e}")
+                    time.sleep(sleep_time)
+                    continue
             raise
     
     raise Exception(f"Operation failed after {max_retries} attempts")
 
+class QuotaPacer:
+    """Adaptive pause between Gmail batches, driven only by 429 responses
+    
+    Batches run back to back until Gmail rate limits; each 429 doubles the pause
+    (or uses Retry-After) and each successful batch halves it again.
+    """
+    
+    def __init__(self, min_backoff=1.0, max_backoff=32):
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._backoff = 0.0
+        self._lock = threading.Lock()
+    
+    def record(self, error=None):
+        """Record how a batch went: the HttpError it raised, if any"""
+        with self._lock:
+            if isinstance(error, HttpError) and error.resp.status == 429:
+                retry_after = _retry_after_seconds(error)
+                if retry_after is None:
+                    retry_after = max(self.min_backoff, self._backoff * 2)
+                self._backoff = min(self.max_backoff, retry_after) * random.uniform(1.0, 1.3)
+            else:
+                # Recover quickly: one success steps the pause down by half
+                self._backoff = self._backoff / 2 if self._backoff >= 0.1 else 0.0
+    
+    def wait(self):
+        """Sleep for the current pause, if any"""
+        with self._lock:
+            backoff = self._backoff
+        if backoff:
+            time.sleep(backoff)
+
+def extract_headers(message, defaults=HEADER_DEFAULTS):
+    """Pick the wanted headers out of a message payload, falling back to defaults
+    
+    Header names are matched case-insensitively; results use the names in defaults.
+    """
+    headers = dict(defaults)
+    wanted = {name.lower(): name for name in defaults}
+    for header in message.get('payload', {}).get('headers', ()):
+        name = wanted.get(header['name'].lower())
+        if name:
+            headers[name] = header['value']
+    return headers
+
+def invalidate_messages_metadata(user_id, message_ids):
+    """Retire cached metadata after messages' labels have changed, in every process"""
+    if message_ids:
+        bump_listing_version(user_id)
+
+def _listing_version_key(user_id):
+    return f"gmail_listing_version_{user_id}"
+
+def listing_version(user_id):
+    """Version of a user's cached list/search results; bumped whenever their messages change"""
+    return cache.get(_listing_version_key(user_id), 0)
+
+def bump_listing_version(user_id):
+    key = _listing_version_key(user_id)
+    cache.add(key, 0, None)
+    cache.incr(key)
+
+def fetch_messages_metadata(service, message_ids, metadata_headers=METADATA_HEADERS, http_factory=None, user_id=None):
+    """Fetch message metadata through Gmail batch requests, preserving input order
+    
+    When http_factory is given, batches run concurrently on a small thread pool,
+    each worker using its own HTTP transport since httplib2 is not thread-safe.
+    When user_id is given, recently fetched messages are served from a process-local cache
+    for as long as the user's listing version is unchanged.
+    """
+    messages = {}
+    # Sub-requests Gmail rate limited or failed transiently inside an otherwise successful batch
+    retry_ids = set()
+    # One shared-cache read per call; entries from before the user's last change are ignored
+    cache_prefix = (user_id, listing_version(user_id), tuple(metadata_headers)) if user_id is not None else None
+    
+    def collect(request_id, response, exception):
+        if exception is not None:
+            if isinstance(exception, HttpError) and exception.resp.status == 404:
+                logger.warning(f"Message {request_id} not found, skipping")
+            elif isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUS_CODES:
+                retry_ids.add(request_id)
+            else:
+                logger.warning(f"Failed to get message details for {request_id}: {exception}")
+            return
+        messages[request_id] = response
+        if user_id is not None:
+            with _metadata_cache_lock:
+                _metadata_cache[cache_prefix + (request_id,)] = response
+    
+    def get_request(msg_id):
+        return service.users().messages().get(
+            userId='me',
+            id=msg_id,
+            format='metadata',
+            metadataHeaders=metadata_headers,
+            fields=METADATA_FIELDS
+        )
+    
+    def fetch_chunk(batch_ids):
+        http = http_factory() if http_factory else None
+        
+        def execute_batch():
+            batch = service.new_batch_http_request(callback=collect)
+            for msg_id in batch_ids:
+                batch.add(get_request(msg_id), request_id=msg_id)
+            batch.execute(http=http)
+        
+        try:
+            retry_gmail_operation(execute_batch)
+        except Exception as e:
+            # Fall back to individual requests for ids the batch did not return
+            logger.warning(f"Batch metadata request failed, falling back to single requests: {e}")
+            fetch_individually([msg_id for msg_id in batch_ids if msg_id not in messages])
+            return
+        
+        # Partial 429/5xx failures are retried one by one, with backoff, overlapping their waits
+        throttled_ids = [msg_id for msg_id in batch_ids if msg_id in retry_ids and msg_id not in messages]
+        if throttled_ids:
+            logger.warning(f"Retrying {len(throttled_ids)} rate-limited messages individually")
+            fetch_individually(throttled_ids)
+    
+    def fetch_individually(msg_ids):
+        if http_factory:
+            with ThreadPoolExecutor(max_workers=GMAIL_MAX_WORKERS) as executor:
+                list(executor.map(fetch_single, msg_ids))
+        else:
+            for msg_id in msg_ids:
+                fetch_single(msg_id)
+    
+    def fetch_single(msg_id):
+        # Runs on its own worker thread when http_factory is given
+        http = http_factory() if http_factory else None
+        try:
+            collect(msg_id, retry_gmail_operation(lambda: get_request(msg_id).execute(http=http)), None)
+        except Exception as e:
+            # A network or refresh error skips this message, not the whole page
+            collect(msg_id, None, e)
+    
+    # Batch request ids must be unique
+    unique_ids = list(dict.fromkeys(message_ids))
+    
+    # Only messages missing from the cache go to Gmail
+    if user_id is not None:
+        with _metadata_cache_lock:
+            for msg_id in unique_ids:
+                cached = _metadata_cache.get(cache_prefix + (msg_id,))
+                if cached is not None:
+                    messages[msg_id] = cached
+    uncached_ids = [msg_id for msg_id in unique_ids if msg_id not in messages]
+    chunks = [uncached_ids[i:i + GMAIL_BATCH_SIZE] for i in range(0, len(uncached_ids), GMAIL_BATCH_SIZE)]
+    
+    if http_factory and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=min(GMAIL_MAX_WORKERS, len(chunks))) as executor:
+            for future in as_completed([executor.submit(fetch_chunk, chunk) for chunk in chunks]):
+                future.result()
+    else:
+        for chunk in chunks:
+            fetch_chunk(chunk)
+    
+    return [messages[msg_id] for msg_id in unique_ids if msg_id in messages]
+
+def _credentials_cache_key(user_id):
+    return f"google_credentials_{user_id}"
+
+def profile_cache_key(user_id):
+    return f"gmail_profile_{user_id}"
+
+def _credentials_generation_key(user_id):
+    return f"google_credentials_generation_{user_id}"
+
+def credentials_generation(user_id):
+    """Generation of a user's stored token; services built under an older one are rebuilt"""
+    return cache.get(_credentials_generation_key(user_id), 0)
+
+def invalidate_cached_credentials(user_id):
+    """Forget cached token fields after the stored token changes or is removed"""
+    cache.delete_many([_credentials_cache_key(user_id), profile_cache_key(user_id)])
+    # Services any web or Celery process built with the old token are not reused
+    key = _credentials_generation_key(user_id)
+    cache.add(key, 0, None)
+    cache.incr(key)
+
+def _naive_utc(value):
+    """google-auth compares expiries against naive UTC datetimes (TIME_ZONE is UTC)"""
+    return timezone.make_naive(value) if value and timezone.is_aware(value) else value
+
+def _cache_credentials(user_id, token):
+    """Cache the stored token fields until shortly before the access token expires"""
+    timeout = CREDENTIALS_CACHE_SECONDS
+    if token.expiry:
+        # Expire the entry before the token enters the refresh window
+        timeout = min(timeout, int((token.expiry - timezone.now()).total_seconds()) - CREDENTIALS_REFRESH_WINDOW_SECONDS)
+    if timeout > 0:
+        cache.set(_credentials_cache_key(user_id), {
+            'token': token.access_token,
+            'refresh_token': token.refresh_token,
+            'token_uri': token.token_uri,
+            'client_id': token.client_id,
+            'client_secret': token.client_secret,
+            'scopes': token.scopes,
+            'expiry': _naive_utc(token.expiry),
+        }, timeout)
+
 def get_credentials_for_user(user):
     """Unified function for getting and refreshing Google credentials"""
+    cached = cache.get(_credentials_cache_key(user.id))
+    if cached:
+        return Credentials(**cached)
+    
     try:
-        token = GoogleOAuthToken.objects.get(user=user)
+        token = GoogleOAuthToken.objects.only(*TOKEN_CREDENTIAL_FIELDS).filter(user_id=user.id).first()
+        if token is None:
+            return None
         
         credentials = Credentials(
             token=token.access_token,
@@ -193,43 +565,62 @@ def get_credentials_for_user(user):
             token_uri=token.token_uri,
             client_id=token.client_id,
             client_secret=token.client_secret,
-            scopes=token.scopes
+            scopes=token.scopes,
+            expiry=_naive_utc(token.expiry)
         )
         
-        # Proactive refresh - refresh if expiring within 5 minutes
-        if credentials.expiry:
-            time_until_expiry = credentials.expiry - datetime.utcnow()
-            should_refresh = time_until_expiry.total_seconds() < 300  # 5 minutes
+        # Proactive refresh - refresh if expiring within 10 minutes so long bulk tasks
+        # keep a valid token; AuthorizedHttp refreshes on 401 after that
+        if token.expiry:
+            # Plain epoch comparison; the stored expiry is timezone-aware
+            should_refresh = time.time() >= token.expiry.timestamp() - CREDENTIALS_REFRESH_WINDOW_SECONDS
         else:
             should_refresh = credentials.expired
         
         if should_refresh and credentials.refresh_token:
-            try:
-                logger.info(f"Refreshing token for user {user.username}")
-                credentials.refresh(Request())
-                
-                # Update database
-                token.access_token = credentials.token
-                token.expiry = credentials.expiry
-                token.save()
-                
-                logger.info(f"Token refreshed successfully for user {user.username}")
-                
-            except RefreshError as e:
-                # Only delete tokens if refresh token is actually invalid
-                if 'invalid_grant' in str(e).lower():
-                    logger.error(f"Refresh token invalid, deleting for user {user.username}")
-                    token.delete()
-                    return None
-                else:
-                    # For other errors, log but don't delete tokens
-                    logger.warning(f"Token refresh failed temporarily: {e}")
-                    # Continue with existing credentials
+            # One refresh per process at a time; a waiting thread picks up the fresh token
+            with _credentials_refresh_lock:
+                cached = cache.get(_credentials_cache_key(user.id))
+                if cached:
+                    return Credentials(**cached)
+                return _refresh_credentials(user, token, credentials)
         
+        _cache_credentials(user.id, token)
         return credentials
         
-    except GoogleOAuthToken.DoesNotExist:
-        return None
     except Exception as e:
         logger.error(f"Error getting credentials: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def _refresh_credentials(user, token, credentials):
+    """Refresh an expiring access token and store the new one"""
+    try:
+        logger.info(f"Refreshing token for user {user.username}")
+        credentials.refresh(_token_refresh_request)
+        
+        # Update database, writing only the refreshed columns
+        token.access_token = credentials.token
+        token.expiry = timezone.make_aware(credentials.expiry) if credentials.expiry else None
+        GoogleOAuthToken.objects.filter(pk=token.pk).update(
+            access_token=token.access_token,
+            expiry=token.expiry,
+            updated_at=timezone.now()
+        )
+        invalidate_cached_credentials(user.id)
+        
+        logger.info(f"Token refreshed successfully for user {user.username}")
+        
+    except RefreshError as e:
+        # Only delete tokens if refresh token is actually invalid
+        if 'invalid_grant' in str(e).lower():
+            logger.error(f"Refresh token invalid, deleting for user {user.username}")
+            token.delete()
+            invalidate_cached_credentials(user.id)
+            return None
+        else:
+            # For other errors, log but don't delete tokens
+            logger.warning(f"Token refresh failed temporarily: {e}")
+            # Continue with existing credentials
+    
+    _cache_credentials(user.id, token)
+    return credentials
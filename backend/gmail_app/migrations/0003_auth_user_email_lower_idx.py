@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('gmail_app', '0002_alter_googleoauthtoken_refresh_token'),
+    ]
+
+    # Case-insensitive unique emails, enforced by the database. Blank emails map to NULL
+    # so accounts created without one (e.g. createsuperuser) don't collide
+    operations = [
+        migrations.RunSQL(
+            sql="CREATE UNIQUE INDEX auth_user_email_lower_idx ON auth_user ((NULLIF(LOWER(email), '')))",
+            reverse_sql="DROP INDEX auth_user_email_lower_idx ON auth_user",
+        ),
+    ]
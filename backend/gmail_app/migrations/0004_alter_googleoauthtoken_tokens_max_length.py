@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0003_auth_user_email_lower_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='googleoauthtoken',
+            name='access_token',
+            field=models.CharField(max_length=2048),
+        ),
+        migrations.AlterField(
+            model_name='googleoauthtoken',
+            name='refresh_token',
+            field=models.CharField(blank=True, max_length=2048, null=True),
+        ),
+    ]
@@ -6,8 +6,9 @@ from django.utils import timezone
 
 class GoogleOAuthToken(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='google_token')
-    access_token = models.TextField()
-    refresh_token = models.TextField(null=True, blank=True)
+    # Inline VARCHARs rather than TEXT blobs; Google tokens are well under 2KB
+    access_token = models.CharField(max_length=2048)
+    refresh_token = models.CharField(max_length=2048, null=True, blank=True)
     token_uri = models.URLField(default = 'https://oauth2.googleapis.com/token')
     client_id = models.CharField(max_length=255)
     client_secret = models.CharField(max_length=255)
@@ -3,9 +3,14 @@ from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.password_validation import validate_password
+from django.db import IntegrityError
+from rest_framework.validators import UniqueValidator
 
 from .models import GoogleOAuthToken
 
+# Unique LOWER(email) index on auth_user, added by migration 0003
+EMAIL_UNIQUE_INDEX = 'auth_user_email_lower_idx'
+
 
 class UserLoginSerializer(serializers.Serializer):
     username = serializers.CharField()
@@ -31,16 +36,14 @@ class UserLoginSerializer(serializers.Serializer):
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only = True, validators = [validate_password])
     password_confirm = serializers.CharField(write_only = True)
+    email = serializers.EmailField(validators = [
+        UniqueValidator(queryset = User.objects.all(), lookup = 'iexact', message = "Email already exists")
+    ])
 
     class Meta:
         model = User
         fields = ('username', 'email', 'password', 'password_confirm')
 
-    def validate_email(self, value):
-        if User.objects.filter(email = value).exists():
-            raise serializers.ValidationError("Email already exists")
-        return value
-
     def validate(self, attrs):
         if attrs['password'] != attrs['password_confirm']:
             raise serializers.ValidationError("Passwords don't match")   
@@ -49,7 +52,16 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         validated_data.pop('password_confirm')
         validated_data['password'] = make_password(validated_data['password'])
-        user = User.objects.create(**validated_data)
+        try:
+            user = User.objects.create(**validated_data)
+        except IntegrityError as e:
+            # Unique constraints catch registrations racing past the validators; the
+            # error names the index that was hit
+            if EMAIL_UNIQUE_INDEX in str(e):
+                raise serializers.ValidationError({'email': "Email already exists"})
+            if 'username' in str(e):
+                raise serializers.ValidationError({'username': "A user with that username already exists."})
+            raise
         return user
     
     
@@ -0,0 +1,45 @@
+import logging
+from celery import shared_task
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from .gmail_utils import profile_cache_key
+from .gmail_operations import LABELS_CACHE_SECONDS, labels_cache_key, organize_labels
+from .utils import create_gmail_service
+
+logger = logging.getLogger(__name__)
+
+@shared_task(ignore_result=True)
+def verify_gmail_after_oauth(user_id):
+    """Check a freshly connected account and warm the profile and labels the dashboard loads first"""
+    try:
+        user = User.objects.get(id=user_id)
+        gmail_service = create_gmail_service(user)
+        if not gmail_service:
+            logger.error(f"Gmail service unavailable after OAuth for user {user_id}")
+            return
+        
+        # Profile and labels go out in one batched round trip
+        responses = {}
+        
+        def collect(request_id, response, exception):
+            if exception is not None:
+                logger.warning(f"Post-OAuth {request_id} request failed for user {user_id}: {exception}")
+                return
+            responses[request_id] = response
+        
+        batch = gmail_service.new_batch_http_request(callback=collect)
+        batch.add(gmail_service.users().getProfile(userId='me'), request_id='profile')
+        batch.add(gmail_service.users().labels().list(userId='me'), request_id='labels')
+        batch.execute()
+        
+        if 'labels' in responses:
+            cache.set(labels_cache_key(user_id), organize_labels(responses['labels'].get('labels', [])), LABELS_CACHE_SECONDS)
+        
+        profile = responses.get('profile')
+        if profile is None:
+            logger.error(f"Gmail API test failed for user {user_id}: profile unavailable")
+            return
+        cache.set(profile_cache_key(user_id), profile, 60)
+        logger.info(f"Gmail connected for user {user.username}: {profile.get('emailAddress', 'Unknown')}")
+    except Exception as e:
+        logger.error(f"Gmail API test failed for user {user_id}: {e}")
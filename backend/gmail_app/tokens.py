@@ -0,0 +1,52 @@
+import hashlib
+import time
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from rest_framework import serializers
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+# Revoked refresh tokens live in the (Redis) cache until they would have expired anyway,
+# so the denylist purges itself and nothing is written for tokens that are never revoked
+
+def _denylist_key(jti):
+    return f"jwt_denylist_{hashlib.sha256(jti.encode()).hexdigest()}"
+
+def denylist_token(token):
+    """Revoke a refresh token for the rest of its lifetime"""
+    remaining = int(token['exp'] - time.time())
+    if remaining > 0:
+        cache.add(_denylist_key(token['jti']), 1, remaining)
+
+def is_denylisted(token):
+    return cache.get(_denylist_key(token['jti'])) is not None
+
+
+class DenylistTokenRefreshSerializer(serializers.Serializer):
+    """simplejwt's refresh with rotation, revoking the used token in the denylist"""
+    refresh = serializers.CharField()
+    access = serializers.CharField(read_only=True)
+
+    def validate(self, attrs):
+        refresh = RefreshToken(attrs['refresh'])
+        if is_denylisted(refresh):
+            raise InvalidToken('Token is blacklisted')
+
+        # Don't issue tokens to users removed or deactivated since the token was issued
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM)
+        user = get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+        if user is None or not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise InvalidToken('No active account found for the given token.')
+
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                denylist_token(refresh)
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data['refresh'] = str(refresh)
+
+        return data
@@ -1,7 +1,6 @@
-from django.urls import path
+from django.urls import path, re_path
 from .views import ProfileView, UserRegistrationView, UserLoginView, UserLogoutView
 from .views import GoogleAuthURLView, GoogleOAuthCallbackView, GoogleTokenStatusView, GoogleTokenRevokeView, GmailConnectivityTestView
-from rest_framework_simplejwt.views import TokenRefreshView
 from .views import GmailEmailListView, GmailEmailMetadataView, GmailSearchView, GmailLabelsView
 from . import views
 
@@ -10,7 +9,7 @@ urlpatterns = [
     path("auth/register/",  UserRegistrationView.as_view(), name="user_register"),
     path('auth/login/', UserLoginView.as_view(), name = 'user_login'),
     path('auth/logout/', UserLogoutView.as_view(), name = 'user_logout'),
-    path('auth/refresh/', TokenRefreshView.as_view(), name = 'token_refresh'),
+    path('auth/refresh/', views.DenylistTokenRefreshView.as_view(), name = 'token_refresh'),
     # URL to view profile of the user
     path('profile/', ProfileView.as_view(), name='user_profile'),   
     #OAuth related apis
@@ -33,7 +32,8 @@ urlpatterns = [
     path('gmail/emails/recover/<str:message_id>/', views.EmailRecoverView.as_view(), name='email_recover'),
     path('gmail/emails/bulk-delete/', views.BulkEmailDeleteView.as_view(), name='bulk_email_delete'),
     path('gmail/emails/bulk-recover/', views.BulkEmailRecoverView.as_view(), name='bulk_email_recover'),
-    path('tasks/<str:task_id>/', views.TaskStatusView.as_view(), name='task_status'),
+    # Celery task ids are UUIDs; anything else 404s without a result backend lookup
+    re_path(r'^tasks/(?P<task_id>[0-9a-f-]{36})/$', views.TaskStatusView.as_view(), name='task_status'),
 
     #Deletion?recovery bt query for testing
     path('gmail/delete-by-query/', views.DeleteByQueryView.as_view(), name='query_email_delete'),
@@ -1,32 +1,44 @@
 import json
+from functools import lru_cache
 from google_auth_oauthlib.flow import Flow
 from django.conf import settings 
+from django.core import signing
 from .models import GoogleOAuthToken
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-import requests
+from .gmail_utils import _SESSION, GmailServiceManager, invalidate_cached_credentials
 
 # Adding logger for enchanced debugging
 import logging
 logger = logging.getLogger(__name__)
 
+TOKEN_URL = 'https://oauth2.googleapis.com/token'
+REVOKE_URL = 'https://oauth2.googleapis.com/revoke'
+
+# Upper bounds on how long the OAuth callback and token revocation can hold a worker waiting on Google
+TOKEN_EXCHANGE_TIMEOUT = 10
+REVOKE_TIMEOUT = 5
+
+
+@lru_cache(maxsize=1)
+def _client_config():
+    """OAuth client config, built once per process from settings"""
+    return {
+        "web": {
+            "client_id": settings.GOOGLE_OAUTH2_CLIENT_ID,
+            "client_secret": settings.GOOGLE_OAUTH2_CLIENT_SECRET,
+            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+            "token_uri": TOKEN_URL,
+            "redirect_uris": [settings.GOOGLE_OAUTH2_REDIRECT_URI]
+        }
+    }
+
 
 """Create Google OAuth2 flow"""
 def get_google_auth_flow():
 
     try:
+        # A Flow keeps per-authorization state (e.g. the PKCE verifier), so only the config is shared
         flow = Flow.from_client_config(
-            {
-                "web": {
-                    "client_id": settings.GOOGLE_OAUTH2_CLIENT_ID,
-                    "client_secret": settings.GOOGLE_OAUTH2_CLIENT_SECRET,
-                    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                    "token_uri": "https://oauth2.googleapis.com/token",
-                    "redirect_uris": [settings.GOOGLE_OAUTH2_REDIRECT_URI]
-                }
-            },
+            _client_config(),
             scopes=settings.GMAIL_SCOPES
 
         )
@@ -38,6 +50,19 @@ def get_google_auth_flow():
 
 
 """Generate Google OAuth2 authorization URL"""
+# The OAuth state is the signed user id, so the callback can trust it without a lookup
+OAUTH_STATE_SALT = 'oauth-state'
+OAUTH_STATE_MAX_AGE = 600
+
+
+def user_id_from_state(state):
+    """Return the user id signed into an OAuth state, or None if it is forged or expired"""
+    try:
+        return int(signing.TimestampSigner(salt=OAUTH_STATE_SALT).unsign(state, max_age=OAUTH_STATE_MAX_AGE))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
 def generate_auth_url(user_id):
     flow = get_google_auth_flow()
 
@@ -48,7 +73,7 @@ def generate_auth_url(user_id):
         auth_url, state = flow.authorization_url(
             access_type='offline',
             include_granted_scopes='true',
-            state=str(user_id),
+            state=signing.TimestampSigner(salt=OAUTH_STATE_SALT).sign(str(user_id)),
             prompt='consent'  # Force consent to get refresh token
         )
         return auth_url, state
@@ -57,19 +82,20 @@ def generate_auth_url(user_id):
         return None, None
 
 
-def exchange_code_for_tokens(code):
-    """Manually exchange authorization code for OAuth tokens"""
-    token_url = 'https://oauth2.googleapis.com/token'
-    
-    token_data = {
+@lru_cache(maxsize=1)
+def _base_token_data():
+    """Static part of the code exchange request, built once per process from settings"""
+    return {
         'client_id': settings.GOOGLE_OAUTH2_CLIENT_ID,
         'client_secret': settings.GOOGLE_OAUTH2_CLIENT_SECRET,
-        'code': code,
         'grant_type': 'authorization_code',
         'redirect_uri': settings.GOOGLE_OAUTH2_REDIRECT_URI
     }
-    
-    response = requests.post(token_url, data=token_data)
+
+
+def exchange_code_for_tokens(code):
+    """Manually exchange authorization code for OAuth tokens"""
+    response = _SESSION.post(TOKEN_URL, data={**_base_token_data(), 'code': code}, timeout=TOKEN_EXCHANGE_TIMEOUT)
     
     if response.status_code != 200:
         raise Exception(f'Token exchange failed: {response.text}')
@@ -77,81 +103,32 @@ def exchange_code_for_tokens(code):
     return response.json()
 
 
-"""Get valid Google credentials for a user"""
-def get_credentials_for_user(user):
-    try:
-        token = GoogleOAuthToken.objects.get(user=user)
-
-        credentials = Credentials(
-            token=token.access_token,
-            refresh_token=token.refresh_token,
-            token_uri=token.token_uri,
-            client_id=token.client_id,
-            client_secret=token.client_secret,
-            scopes=token.scopes
-        )
-
-        # Refresh token if expired
-        if credentials.expired and credentials.refresh_token:
-            try:
-                credentials.refresh(Request())
-                
-                # Update stored token
-                token.access_token = credentials.token
-                if credentials.expiry:
-                    token.expiry = credentials.expiry
-                token.save()
-                
-                logger.info(f"Token refreshed for user {user.username}")
-                
-            except Exception as e:
-                logger.error(f"Token refresh failed for user {user.username}: {e}")
-                return None
-        
-        return credentials
-    
-    except GoogleOAuthToken.DoesNotExist:
-        logger.warning(f"No OAuth token found for user {user.username}")
-        return None
-    except Exception as e:
-        logger.error(f"Error getting credentials for user {user.username}: {e}")
-        return None
-    
-
-
 """Create Gmail API service for a user"""
 def create_gmail_service(user):
-    credentials = get_credentials_for_user(user)
-    if not credentials:
-        return None
-    
-    # return build('gmail', 'v1', credentials=credentials)
-
-    try:
-        service = build('gmail', 'v1', credentials=credentials)
-        # Test the connection
-        service.users().getProfile(userId='me').execute()
-        return service
-    except HttpError as e:
-        logger.error(f"Gmail API error for user {user.username}: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"Failed to create Gmail service for user {user.username}: {e}")
-        return None
+    # Reuses the service this thread built recently for the user
+    return GmailServiceManager(user).get_service()
     
     
-"""Revoke and delete user's OAuth tokens"""
+"""Delete user's OAuth tokens and revoke them with Google"""
 def revoke_user_tokens(user):
     try:
-        credentials = get_credentials_for_user(user)
-        if credentials:
-            # Revoke token with Google
-            revoke_url = f"https://oauth2.googleapis.com/revoke?token={credentials.token}"
-            import requests
-            requests.post(revoke_url)
+        # Revoking the refresh token ends the whole grant; no need to refresh an expired access token first
+        # MySQL has no DELETE ... RETURNING, so read the two values first and only delete a row that exists
+        token = GoogleOAuthToken.objects.filter(user=user).values_list('access_token', 'refresh_token').first()
         
-        # Delete from database
-        GoogleOAuthToken.objects.filter(user=user).delete()
+        if token:
+            GoogleOAuthToken.objects.filter(user=user).delete()
+            # Revoke with Google in the request, so the raw token never lands in the task broker;
+            # the short timeout bounds the wait, and the local tokens are already gone either way
+            access_token, refresh_token = token
+            try:
+                response = _SESSION.post(REVOKE_URL, params={'token': refresh_token or access_token}, timeout=REVOKE_TIMEOUT)
+                if response.status_code != 200:
+                    logger.warning(f"Google token revocation returned {response.status_code} for user {user.username}")
+            except Exception as e:
+                logger.warning(f"Google token revocation failed for user {user.username}: {e}")
+        # Drop cached credentials, services and profile even if the row was already gone
+        invalidate_cached_credentials(user.id)
         logger.info(f"OAuth tokens revoked for user {user.username}")
         return True
     except Exception as e:
@@ -8,23 +8,29 @@ from .serializers import UserRegistrationSerializer, UserSerializer, UserLoginSe
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from rest_framework_simplejwt.views import TokenRefreshView
+from .tokens import DenylistTokenRefreshSerializer, denylist_token
 from rest_framework_simplejwt.exceptions import TokenError
 
 # Importing OAuth related things
-from django.contrib.auth.models import User
 from django.shortcuts import redirect
-from .utils import generate_auth_url, exchange_code_for_tokens, create_gmail_service, revoke_user_tokens
+from django.db import transaction
+from .utils import generate_auth_url, user_id_from_state, exchange_code_for_tokens, create_gmail_service, revoke_user_tokens
+from .gmail_utils import profile_cache_key, test_gmail_connectivity, invalidate_cached_credentials
+from django.core.cache import cache
 from .models import GoogleOAuthToken
 from .serializers import GoogleAuthURLSerializer, GoogleOAuthSerializer
 
 from django.conf import settings
-import importlib
-from datetime import timedelta, datetime
+from datetime import timedelta
+from django.utils import timezone
+from django.utils.http import parse_etags
 
 from .gmail_operations import GmailOperations, build_search_query
 
 from celery.result import AsyncResult
 from .email_operations import EmailDeletionManager, bulk_delete_emails_task, bulk_recover_emails_task, recover_by_query_task, delete_by_query_task
+from .tasks import verify_gmail_after_oauth
+from .advanced_operations import EmailPreviewManager, SmartDeletionRules, UndoManager
 
 # Adding logger for enchanced debugging
 import logging
@@ -32,6 +38,15 @@ logger = logging.getLogger(__name__)
 
 # ****************************************Login/Register related Views*********************************
 
+def _user_payload(user):
+    """Same fields and formats as UserSerializer, without building a serializer per auth request"""
+    return {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'date_joined': user.date_joined.isoformat().replace('+00:00', 'Z')
+    }
+
 class UserLoginView(APIView):
     permission_classes = [AllowAny]
     
@@ -43,7 +58,7 @@ class UserLoginView(APIView):
 
             return Response({
                 'message' : 'Login Succesful',
-                'user' : UserSerializer(user).data,
+                'user' : _user_payload(user),
                 'tokens' : {
                     'refresh' : str(refresh),
                     'access' : str(refresh.access_token)
@@ -53,6 +68,10 @@ class UserLoginView(APIView):
         return Response(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
     
 
+class DenylistTokenRefreshView(TokenRefreshView):
+    serializer_class = DenylistTokenRefreshSerializer
+
+
 class UserLogoutView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -60,8 +79,7 @@ class UserLogoutView(APIView):
         try:
             refresh_token = request.data.get('refresh')
             if refresh_token:
-                token = RefreshToken(refresh_token)
-                token.blacklist()
+                denylist_token(RefreshToken(refresh_token))
                 
             return Response({
                 'message': 'Logout successful'
@@ -86,7 +104,7 @@ class UserRegistrationView(generics.CreateAPIView):
 
         return Response({
             'message' : 'User created successfully',
-            'user' : UserSerializer(user).data,
+            'user' : _user_payload(user),
             'tokens': {
                 'refresh': str(refresh),
                 'access': str(refresh.access_token),
@@ -137,6 +155,8 @@ class GoogleAuthURLView(APIView):
 
 class GoogleOAuthCallbackView(APIView):
     permission_classes = [AllowAny]
+    # Google's redirect carries no bearer token; the user comes from the signed state
+    authentication_classes = []
 
     def get(self, request):
         """Handle Google OAuth2 callback and redirect to frontend"""
@@ -156,23 +176,23 @@ class GoogleOAuthCallbackView(APIView):
             return redirect(f"{frontend_url}/dashboard?oauth=error&message=missing_parameters")
         
         try:
-            # Validate user from state
-            try:
-                user = User.objects.get(id=int(state))
-            except (User.DoesNotExist, ValueError):
+            # The state is signed by generate_auth_url, so the user id in it needs no lookup
+            user_id = user_id_from_state(state)
+            if user_id is None:
                 logger.error(f"Invalid state parameter: {state}")
                 return redirect(f"{frontend_url}/dashboard?oauth=error&message=invalid_state")
+            token = GoogleOAuthToken.objects.filter(user_id=user_id).first()
         
             # Manual token exchange with enhanced error handling
             try:
                 token_response = exchange_code_for_tokens(code)
             except Exception as e:
-                logger.error(f"Token exchange failed for user {user.username}: {e}")
+                logger.error(f"Token exchange failed for user {user_id}: {e}")
                 return redirect(f"{frontend_url}/dashboard?oauth=error&message=token_exchange_failed")
 
             # Validate required tokens
             if 'access_token' not in token_response:
-                logger.error(f"No access token received for user {user.username}")
+                logger.error(f"No access token received for user {user_id}")
                 return redirect(f"{frontend_url}/dashboard?oauth=error&message=invalid_token_response")
 
             # Get granted scopes from URL parameter
@@ -184,90 +204,67 @@ class GoogleOAuthCallbackView(APIView):
             missing_scopes = [scope for scope in required_scopes if scope not in granted_scopes]
             
             if missing_scopes:
-                logger.warning(f"Missing required scopes for user {user.username}: {missing_scopes}")
+                logger.warning(f"Missing required scopes for user {user_id}: {missing_scopes}")
                 return redirect(f"{frontend_url}/dashboard?oauth=error&message=missing_scopes")
 
             # Calculate expiry with timezone awareness
             expiry = None
             if 'expires_in' in token_response:
-                from django.utils import timezone
                 expiry = timezone.now() + timedelta(seconds=token_response['expires_in'])
 
-            # Save tokens to database
-            token, created = GoogleOAuthToken.objects.update_or_create(
-                user=user,
-                defaults={
-                    'access_token': token_response['access_token'],
-                    'refresh_token': token_response.get('refresh_token'),
-                    'token_uri': 'https://oauth2.googleapis.com/token',
-                    'client_id': settings.GOOGLE_OAUTH2_CLIENT_ID,
-                    'client_secret': settings.GOOGLE_OAUTH2_CLIENT_SECRET,
-                    'scopes': granted_scopes,
-                    'expiry': expiry
-                }
-            )
+            # Save tokens to database, updating the row loaded above if there is one
+            token_fields = {
+                'access_token': token_response['access_token'],
+                'refresh_token': token_response.get('refresh_token'),
+                'token_uri': 'https://oauth2.googleapis.com/token',
+                'client_id': settings.GOOGLE_OAUTH2_CLIENT_ID,
+                'client_secret': settings.GOOGLE_OAUTH2_CLIENT_SECRET,
+                'scopes': granted_scopes,
+                'expiry': expiry
+            }
+            if token:
+                for field, value in token_fields.items():
+                    setattr(token, field, value)
+                token.save(update_fields=[*token_fields, 'updated_at'])
+            else:
+                token = GoogleOAuthToken.objects.create(user_id=user_id, **token_fields)
+            invalidate_cached_credentials(user_id)
 
-            # Test Gmail API connection
-            gmail_address = 'Unknown'
-            try:
-                gmail_service = create_gmail_service(user)
-                if gmail_service:
-                    profile = gmail_service.users().getProfile(userId='me').execute()
-                    gmail_address = profile.get('emailAddress', 'Unknown')
-                
-            except Exception as e:
-                logger.error(f"Gmail API test failed for user {user.username}: {e}")
-                # Don't fail the whole process, just continue
+            # Test Gmail API connection in the background; the dashboard reads the
+            # result from the token status endpoint
+            transaction.on_commit(lambda: verify_gmail_after_oauth.delay(user_id))
 
-            logger.info(f"OAuth setup successful for user {user.username}, Gmail: {gmail_address}")
+            logger.info(f"OAuth setup successful for user {user_id}")
             
             # Redirect to frontend with success
-            return redirect(f"{frontend_url}/dashboard?oauth=success&email={gmail_address}")
+            return redirect(f"{frontend_url}/dashboard?oauth=success&email=pending")
         
         except Exception as e:
             logger.error(f"OAuth callback error for user state {state}: {e}")
             return redirect(f"{frontend_url}/dashboard?oauth=error&message=server_error")
 
-class GoogleTokenStatusView(APIView):
+class GoogleTokenMixin:
+    """Load the user's Google token once per request, as request.google_token"""
+    # Columns to load; None loads the whole row
+    google_token_fields = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        tokens = GoogleOAuthToken.objects.filter(user=request.user)
+        if self.google_token_fields:
+            tokens = tokens.only(*self.google_token_fields)
+        request.google_token = tokens.first()
+
+
+class GoogleTokenStatusView(GoogleTokenMixin, APIView):
     permission_classes = [IsAuthenticated]
+    # Just what the response shows; credentials are only needed when the profile isn't cached
+    google_token_fields = ('scopes', 'expiry', 'created_at', 'updated_at')
 
     def get(self, request):
         """Check Google OAuth token status with Gmail connectivity test"""
-        try:
-            token = GoogleOAuthToken.objects.get(user=request.user)
-            
-            # Test Gmail connectivity
-            try:
-                gmail_service = create_gmail_service(request.user)
-                is_connected = gmail_service is not None
-                
-                if is_connected:
-                    # Get basic Gmail info
-                    profile = gmail_service.users().getProfile(userId='me').execute()
-                    gmail_info = {
-                        'email_address': profile.get('emailAddress'),
-                        'messages_total': profile.get('messagesTotal', 0),
-                        'threads_total': profile.get('threadsTotal', 0)
-                    }
-                else:
-                    gmail_info = None
-                    
-            except Exception as e:
-                logger.warning(f"Gmail connectivity test failed for user {request.user.username}: {e}")
-                is_connected = False
-                gmail_info = None
-
-            return Response({
-                'has_token': True,
-                'is_expired': token.is_expired(),
-                'is_connected': is_connected,
-                'scopes': token.scopes,
-                'created_at': token.created_at,
-                'updated_at': token.updated_at,
-                'gmail_info': gmail_info
-            })
-            
-        except GoogleOAuthToken.DoesNotExist:
+        token = getattr(request, 'google_token', None)
+        if token is None:
             return Response({
                 'has_token': False,
                 'is_expired': None,
@@ -276,6 +273,43 @@ class GoogleTokenStatusView(APIView):
                 'message': 'No Gmail authorization found. Please authorize first.',
                 'gmail_info': None
             })
+        
+        # Test Gmail connectivity. A profile fetched in the last minute already proves
+        # the connection works; otherwise this thread's cached service is reused
+        try:
+            profile_key = profile_cache_key(request.user.id)
+            profile = cache.get(profile_key)
+            if profile is None:
+                gmail_service = create_gmail_service(request.user)
+                if gmail_service is not None:
+                    profile = gmail_service.users().getProfile(userId='me').execute()
+                    cache.set(profile_key, profile, 60)
+            is_connected = profile is not None
+            
+            if is_connected:
+                # Get basic Gmail info
+                gmail_info = {
+                    'email_address': profile.get('emailAddress'),
+                    'messages_total': profile.get('messagesTotal', 0),
+                    'threads_total': profile.get('threadsTotal', 0)
+                }
+            else:
+                gmail_info = None
+                
+        except Exception as e:
+            logger.warning(f"Gmail connectivity test failed for user {request.user.username}: {e}")
+            is_connected = False
+            gmail_info = None
+
+        return Response({
+            'has_token': True,
+            'is_expired': token.is_expired(),
+            'is_connected': is_connected,
+            'scopes': token.scopes,
+            'created_at': token.created_at,
+            'updated_at': token.updated_at,
+            'gmail_info': gmail_info
+        })
 
 
 class GoogleTokenRevokeView(APIView):
@@ -311,8 +345,6 @@ class GoogleTokenRevokeView(APIView):
 # *******************************************Gmail Connectivity Test Views*******************************************
 
 
-from .gmail_utils import test_gmail_connectivity, GmailServiceManager
-
 class GmailConnectivityTestView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -348,11 +380,10 @@ class GmailConnectivityTestView(APIView):
     def post(self, request):
         """Force refresh Gmail connection"""
         try:
-            manager = GmailServiceManager(request.user)
-            service = manager.get_service(force_refresh=True)
+            # Rebuild and probe in one pass rather than building the service twice
+            connectivity_result = test_gmail_connectivity(request.user, force_refresh=True)
             
-            if service:
-                connectivity_result = test_gmail_connectivity(request.user)
+            if connectivity_result['connected']:
                 return Response({
                     'status': 'success',
                     'connected': True,
@@ -363,7 +394,7 @@ class GmailConnectivityTestView(APIView):
                 return Response({
                     'status': 'error',
                     'connected': False,
-                    'error': manager.get_last_error(),
+                    'error': connectivity_result['error'],
                     'message': 'Failed to refresh Gmail connection'
                 }, status=status.HTTP_400_BAD_REQUEST)
                 
@@ -376,13 +407,19 @@ class GmailConnectivityTestView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
 
+def _page_size_param(request, default=20):
+    """page_size query param clamped to Gmail's 1-500 range; malformed values fall back to the default"""
+    raw = request.GET.get('page_size', '')
+    page_size = int(raw) if raw.isdecimal() else default
+    return min(max(page_size, 1), 500)
+
 class GmailEmailListView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
         """List emails with pagination"""
         try:
-            page_size = int(request.GET.get('page_size', 20))
+            page_size = _page_size_param(request)
             page_token = request.GET.get('page_token')
             label_ids = request.GET.getlist('label_ids', [])
             
@@ -396,6 +433,14 @@ class GmailEmailListView(APIView):
             
             query = ' '.join(query_parts) if query_parts else ''
             
+            # An unchanged mailbox answers a revalidation with 304 and no listing work.
+            # If-None-Match uses weak comparison, so W/ prefixes are ignored
+            etag = gmail_ops.listing_etag(query, page_size, page_token)
+            if etag:
+                client_etags = parse_etags(request.headers.get('If-None-Match', ''))
+                if '*' in client_etags or etag in {client_etag.removeprefix('W/') for client_etag in client_etags}:
+                    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            
             result = gmail_ops.search_emails(
                 query=query,
                 max_results=page_size,
@@ -409,12 +454,16 @@ class GmailEmailListView(APIView):
                 }, status=status.HTTP_400_BAD_REQUEST)
             
             # Return same structure as search
-            return Response({
+            response = Response({
                 'results': result.get('messages', []),
                 'count': result.get('resultSizeEstimate', 0),
                 'next': result.get('nextPageToken'),
                 'previous': None
             })
+            if etag:
+                response['ETag'] = etag
+                response['Cache-Control'] = 'private, max-age=30'
+            return response
             
         except Exception as e:
             logger.error(f"List emails error for user {request.user.username}: {e}")
@@ -467,7 +516,7 @@ class GmailSearchView(APIView):
         """Search emails with Gmail query syntax"""
         try:
             search_query = request.GET.get('q', '')
-            page_size = int(request.GET.get('page_size', 20))
+            page_size = _page_size_param(request)
             page_token = request.GET.get('page_token')
             
             if not search_query.strip():
@@ -643,7 +692,7 @@ class BulkEmailDeleteView(APIView):
         try:
             message_ids = request.data.get('message_ids', [])
             permanent = request.data.get('permanent', False)
-            batch_size = request.data.get('batch_size', 100)
+            batch_size = request.data.get('batch_size', 1000)
             
             if not message_ids:
                 return Response({
@@ -660,7 +709,7 @@ class BulkEmailDeleteView(APIView):
                 user_id=request.user.id,
                 message_ids=message_ids,
                 permanent=permanent,
-                batch_size=min(batch_size, 500)
+                batch_size=min(batch_size, 1000)  # batchDelete/batchModify accept up to 1000 ids
             )
             
             return Response({
@@ -802,7 +851,8 @@ class DeleteByQueryView(APIView):
                 user_id=request.user.id,
                 search_query=search_query,
                 max_emails=max_emails,
-                permanent=permanent
+                permanent=permanent,
+                with_metadata=bool(request.data.get('with_metadata', False))
             )
             
             return Response({
@@ -863,7 +913,6 @@ class RecoverByQueryView(APIView):
 
 
 # ******************************Advanced operations views********************************************
-from .advanced_operations import EmailPreviewManager, SmartDeletionRules, UndoManager
 
 class EmailPreviewView(APIView):
     permission_classes = [IsAuthenticated]
@@ -970,10 +1019,19 @@ class ExecuteRuleView(APIView):
 class UndoOperationView(APIView):
     permission_classes = [IsAuthenticated]
     
-    def get(self, request):
-        """Get available undo points"""
+    def get(self, request, undo_id=None):
+        """Get available undo points, or the emails snapshotted with one of them"""
         try:
             undo_manager = UndoManager(request.user)
+            
+            if undo_id:
+                # Points with has_metadata carry the sender/subject/date of what they'd restore
+                return Response({
+                    'status': 'success',
+                    'undo_id': undo_id,
+                    'emails': undo_manager.get_undo_metadata(undo_id)
+                })
+            
             undo_points = undo_manager.get_undo_history()
             
             return Response({
@@ -40,7 +40,6 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'corsheaders',
     'rest_framework', #Added DRF
-    'rest_framework_simplejwt.token_blacklist', # Needed because we are using black_list_rotation : true in simplejwt settings   
     'gmail_app' # Main app containing backend logic
 ]
 
@@ -87,6 +86,9 @@ DATABASES = {
         'PASSWORD': os.environ.get('DB_PASSWORD', ''),
         'HOST': os.environ.get('DB_HOST', 'localhost'),
         'PORT': os.environ.get('DB_PORT', '3306'),  
+        # Keep connections open across requests instead of reconnecting for every one
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 # Password validation
@@ -108,6 +110,16 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Argon2 first: new passwords use it, and existing PBKDF2 hashes are upgraded on next login
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.2/topics/i18n/
 
@@ -139,7 +151,18 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',  
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',  
+        'gmail_app.authentication.CachedJWTAuthentication',  
+    ],
+
+    # orjson for the large email listing payloads; the browsable API stays available
+    'DEFAULT_RENDERER_CLASSES': [
+        'drf_orjson_renderer.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'drf_orjson_renderer.parsers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ],
 
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
@@ -157,10 +180,10 @@ REST_FRAMEWORK = {
 
 # JWT Settings
 SIMPLE_JWT = {
-    "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),
+    "ACCESS_TOKEN_LIFETIME": timedelta(minutes=15),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7),
     "ROTATE_REFRESH_TOKENS": True,
-    "BLACKLIST_AFTER_ROTATION": True,
+    "BLACKLIST_AFTER_ROTATION": True,  # Enforced by the cache denylist in gmail_app.tokens
     "UPDATE_LAST_LOGIN": True,
     "ALGORITHM": "HS256",
     "SIGNING_KEY": SECRET_KEY,
@@ -189,6 +212,9 @@ GMAIL_SCOPES = [
 #OAuth2 redirect URI
 GOOGLE_OAUTH2_REDIRECT_URI = os.getenv('GOOGLE_REDIRECT_URI')
 
+# Concurrent Gmail requests per user in bulk operations; keep within Gmail's per-user quota
+GMAIL_MAX_WORKERS = int(os.getenv('GMAIL_MAX_WORKERS', 5))
+
 # Celery Configuration
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -201,6 +227,18 @@ CELERY_ENABLE_UTC = True
 # Task result expiration
 CELERY_RESULT_EXPIRES = 3600
 
+# Cache Configuration
+# Redis-backed so rules and undo points written by Celery workers are visible to the web process
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://localhost:6379/1'),
+        'OPTIONS': {
+            'serializer': 'gmail_app.cache_serializers.CompressedRedisSerializer',
+        },
+    }
+}
+
 
 #For react testinggg
 # Add CORS settings